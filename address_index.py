@@ -0,0 +1,169 @@
+from key_relations import pointToPublicKey, publicKeyToAddress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import threading
+
+# optional secondary index for wallets and explorers: which transactions send from or pay to
+# a public key or address, without scanning the chain.
+
+def public_key_id(public_key):
+    # compressed sec hex, the form keys are indexed by
+    return pointToPublicKey(public_key, compressed=True)
+
+class AddressIndex:
+    '''
+    Public key -> locations (block height, index in block) of its transactions, oldest first,
+    and address -> public key for both the compressed and uncompressed address of every key.
+    Kept up to date by connect_block / disconnect_block, O(transactions in block) each.
+
+    Queries run on the history server's thread. They hold self.lock, which connect_block and
+    disconnect_block take too, and the node holds it around whole chain updates so a query
+    never sees the chain halfway through a reorg.
+    '''
+    def __init__(self):
+        self.locations = {} # compressed public key hex -> [(block_height, index in block)]
+        self.addresses = {} # address -> compressed public key hex
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def _keys(self, tx):
+        keys = {public_key_id(tx.receiver_pk): tx.receiver_pk}
+        if tx.sender_pk is not None:
+            keys[public_key_id(tx.sender_pk)] = tx.sender_pk
+        return keys
+
+    def connect_block(self, block):
+        with self.lock:
+            for index, tx in enumerate(block.transactions):
+                for key, public_key in self._keys(tx).items():
+                    if key not in self.locations:
+                        self.locations[key] = []
+                        self.addresses[publicKeyToAddress(key)] = key
+                        self.addresses[publicKeyToAddress(pointToPublicKey(public_key, compressed=False))] = key
+                    self.locations[key].append((block.block_height, index))
+
+    def disconnect_block(self, block):
+        # the block's locations are the last ones in each list, since it was the last connected
+        with self.lock:
+            for tx in reversed(block.transactions):
+                for key in self._keys(tx):
+                    locations = self.locations[key]
+                    while locations and locations[-1][0] == block.block_height:
+                        locations.pop()
+
+    def catch_up(self, blockchain):
+        for block in blockchain.blocks:
+            self.connect_block(block)
+
+    def resolve(self, key):
+        # compressed public key hex for an address, or a compressed / uncompressed public key hex
+        if key in self.addresses:
+            return self.addresses[key]
+        key = key.upper()
+        if len(key) == 130 and key.startswith('04'):
+            x, y = key[2:66], int(key[66:], 16)
+            key = ('03' if y & 1 else '02') + x
+        return key if key in self.locations else None
+
+    def query(self, blockchain, key, page=0, page_size=50):
+        '''
+        One page of the transactions involving key (address or public key hex), newest first.
+        Returns a dict ready to be sent as json.
+        '''
+        with self.lock:
+            public_key = self.resolve(key)
+            locations = self.locations.get(public_key, []) if public_key is not None else []
+            total = len(locations)
+            end = max(total - page*page_size, 0)
+            start = max(end - page_size, 0)
+            page_locations = [(block_height, index, blockchain.get_block(block_height))
+                              for block_height, index in reversed(locations[start:end])]
+
+        transactions = []
+        for block_height, index, block in page_locations:
+            if block is None or index >= len(block.transactions):
+                continue # disconnected by a chain update the caller didn't lock out
+            tx = block.transactions[index]
+            transactions.append({
+                'tx_id': tx.tx_id,
+                'block_height': block_height,
+                'block_hash': block.block_hash,
+                'sender': public_key_id(tx.sender_pk) if tx.sender_pk is not None else None,
+                'receiver': public_key_id(tx.receiver_pk),
+                'amount': tx.amount,
+                'fee': tx.tx_fee,
+            })
+
+        return {'public_key': public_key, 'total': total, 'page': page, 'page_size': page_size, 'transactions': transactions}
+
+def serve_history(index, blockchain, port, max_page_size=500):
+    '''
+    Answer GET /history/<address or public key>?page=0&page_size=50 with AddressIndex.query as
+    json, on localhost from a background thread.
+    '''
+    class HistoryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'history':
+                self.send_error(404, 'use /history/<address or public key>')
+                return
+
+            params = parse_qs(url.query)
+            try:
+                page = max(int(params.get('page', ['0'])[0]), 0)
+                page_size = min(max(int(params.get('page_size', ['50'])[0]), 1), max_page_size)
+            except ValueError:
+                self.send_error(400, 'page and page_size must be integers')
+                return
+
+            body = json.dumps(index.query(blockchain, parts[1], page, page_size)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # requests aren't worth a line in the node's output
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), HistoryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    from blockchain import Block, Blockchain
+    from transaction import Transaction
+    from elliptic_curve import bitcoin_G
+    from urllib.request import urlopen
+    import time
+
+    alice, bob = bitcoin_G * 5, bitcoin_G * 6
+    chain = Blockchain(block_size=10)
+    index = AddressIndex()
+    prev_block_hash = ''
+    for height in range(30):
+        txs = [Transaction(sender_pk=alice, receiver_pk=bob, amount=height, fee=1), Transaction(sender_pk=bob, receiver_pk=bitcoin_G * (100 + height), amount=1, fee=0)]
+        block = Block(block_height=height, prev_block_hash=prev_block_hash, transactions=txs)
+        block.mine(difficulty=1, block_reward=50, block_reward_receiver=bitcoin_G * 42, iterations=int(1e6))
+        chain.add_block(block)
+        index.connect_block(block)
+        prev_block_hash = block.block_hash
+
+    alice_address = publicKeyToAddress(pointToPublicKey(alice))
+    page = index.query(chain, alice_address, page=0, page_size=10)
+    print(f'address query passed: {page["total"] == 30 and [tx["block_height"] for tx in page["transactions"]] == list(range(29, 19, -1))}')
+    print(f'uncompressed key query passed: {index.query(chain, pointToPublicKey(bob, compressed=False))["total"] == 60}')
+
+    last_block = chain.remove_block()
+    index.disconnect_block(last_block)
+    print(f'disconnect test passed: {index.query(chain, alice_address)["total"] == 29}')
+
+    server = serve_history(index, chain, port=8765)
+    start_time = time.time()
+    response = json.loads(urlopen(f'http://127.0.0.1:8765/history/{alice_address}?page=2&page_size=10').read())
+    print(f'endpoint test passed: {[tx["block_height"] for tx in response["transactions"]] == list(range(8, -1, -1))} in {round((time.time() - start_time)*1000, 2)}ms')
+    server.shutdown()
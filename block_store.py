@@ -0,0 +1,232 @@
+from codec import Encoder, Decoder, encode_block, decode_block, BLOCK_FIELDS
+from collections import OrderedDict
+import mmap
+import os
+import struct
+
+# on-disk block storage. blocks are appended in the binary wire format to numbered segment files,
+# and a memory-mapped index holds one fixed-size record per height, so any block can be found
+# in O(1) without reading the ones before it.
+
+INDEX_HEADER = struct.Struct('<8sQ') # magic, number of blocks
+INDEX_RECORD = struct.Struct('<IQI32sI') # segment number, offset, length, block hash, difficulty
+INDEX_MAGIC = b'BFSPIDX2'
+OLD_INDEX_RECORD = struct.Struct('<IQI32s') # BFSPIDX1, before the difficulty was indexed
+OLD_INDEX_MAGIC = b'BFSPIDX1'
+INDEX_GROWTH = 4096 # records added to the index file each time it fills up
+
+class BlockStore:
+    '''
+    Append-only block store for one chain. Heights start at 0 and are contiguous.
+    Writes are fsynced in batches of sync_every blocks (and on flush / close), so a crash
+    can lose at most the last batch, which is detected and dropped when the store is opened.
+    '''
+    def __init__(self, directory, segment_size=128*1024*1024, sync_every=16):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        os.makedirs(directory, exist_ok=True)
+
+        index_path = os.path.join(directory, 'index.dat')
+        if not os.path.exists(index_path):
+            with open(index_path, 'wb') as index_file:
+                index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, 0))
+                index_file.truncate(INDEX_HEADER.size + INDEX_GROWTH*INDEX_RECORD.size)
+
+        self.segments = {} # segment number -> open file
+        self.index_file = open(index_path, 'r+b')
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+        magic, self.count = INDEX_HEADER.unpack_from(self.index, 0)
+        if magic == OLD_INDEX_MAGIC:
+            self._upgrade_index()
+        elif magic != INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a block index.")
+
+        self.unsynced = 0
+        self._hash_index = None
+
+        self._drop_incomplete_tail()
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, height):
+        return INDEX_RECORD.unpack_from(self.index, INDEX_HEADER.size + height*INDEX_RECORD.size)
+
+    def _upgrade_index(self):
+        # rewrite a BFSPIDX1 index in place, reading each block's difficulty from the start of its encoding
+        records = [OLD_INDEX_RECORD.unpack_from(self.index, INDEX_HEADER.size + height*OLD_INDEX_RECORD.size)
+                   for height in range(self.count)]
+        size = INDEX_HEADER.size + (len(records) + INDEX_GROWTH)*INDEX_RECORD.size
+        if size > len(self.index):
+            self.index.resize(size)
+        for height, (segment, offset, length, block_hash) in enumerate(records):
+            fields = os.pread(self._segment(segment).fileno(), BLOCK_FIELDS.size, offset)
+            difficulty = BLOCK_FIELDS.unpack(fields)[3] if len(fields) == BLOCK_FIELDS.size else 0
+            INDEX_RECORD.pack_into(self.index, INDEX_HEADER.size + height*INDEX_RECORD.size, segment, offset, length, block_hash, difficulty)
+        self._set_count(self.count)
+        self.index.flush()
+
+    def _segment(self, number):
+        if number not in self.segments:
+            path = os.path.join(self.directory, f'blk{number:05d}.dat')
+            self.segments[number] = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        return self.segments[number]
+
+    def _set_count(self, count):
+        self.count = count
+        INDEX_HEADER.pack_into(self.index, 0, INDEX_MAGIC, count)
+
+    def _drop_incomplete_tail(self):
+        # blocks whose data didn't reach the segment file before a crash
+        while self.count:
+            segment, offset, length, _, _ = self._record(self.count - 1)
+            if offset + length <= os.fstat(self._segment(segment).fileno()).st_size:
+                break
+            self._set_count(self.count - 1)
+
+    def append(self, block):
+        encoder = Encoder()
+        encode_block(encoder, block)
+        data = encoder.buffer
+
+        if self.count:
+            segment, offset, length, _, _ = self._record(self.count - 1)
+            offset += length
+            if offset + len(data) > self.segment_size:
+                segment, offset = segment + 1, 0
+        else:
+            segment, offset = 0, 0
+
+        segment_file = self._segment(segment)
+        segment_file.seek(offset)
+        segment_file.write(data)
+        segment_file.truncate() # anything after this offset belongs to truncated blocks
+
+        position = INDEX_HEADER.size + (self.count + 1)*INDEX_RECORD.size
+        if position > len(self.index):
+            self.index.resize(len(self.index) + INDEX_GROWTH*INDEX_RECORD.size)
+        INDEX_RECORD.pack_into(self.index, position - INDEX_RECORD.size, segment, offset, len(data), bytes.fromhex(block.block_hash), block.difficulty or 0)
+        if self._hash_index is not None:
+            self._hash_index[block.block_hash] = self.count
+        self._set_count(self.count + 1)
+
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.flush()
+        return self.count - 1
+
+    def get(self, height):
+        segment, offset, length, _, _ = self._record(height)
+        segment_file = self._segment(segment)
+        segment_file.flush()
+        return decode_block(Decoder(os.pread(segment_file.fileno(), length, offset)))
+
+    def block_hash(self, height):
+        return self._record(height)[3].hex()
+
+    def difficulty(self, height):
+        return self._record(height)[4]
+
+    def hash_index(self):
+        # block_hash -> height, read from the index records without decoding any block
+        if self._hash_index is None:
+            self._hash_index = {self.block_hash(height): height for height in range(self.count)}
+        return self._hash_index
+
+    def truncate(self, count):
+        # forget every block from height count on, e.g. when a reorg disconnects them
+        if self._hash_index is not None:
+            for height in range(count, self.count):
+                self._hash_index.pop(self.block_hash(height), None)
+        self._set_count(min(count, self.count))
+
+    def flush(self):
+        for segment_file in self.segments.values():
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        self.index.flush()
+        self.unsynced = 0
+
+    def close(self):
+        self.flush()
+        self.index.close()
+        self.index_file.close()
+        for segment_file in self.segments.values():
+            segment_file.close()
+
+class StoredBlocks:
+    '''
+    List-like view of a BlockStore, used as Blockchain.blocks. Blocks are decoded on access
+    and the most recently used ones kept in memory, so the chain never has to be loaded whole.
+    '''
+    def __init__(self, store, cache_size=256):
+        self.store = store
+        self.cache = OrderedDict() # height -> block
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("block index out of range")
+
+        block = self.cache.get(position)
+        if block is None:
+            block = self.store.get(position)
+            self.cache[position] = block
+        self.cache.move_to_end(position)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return block
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def append(self, block):
+        position = self.store.append(block)
+        self.cache[position] = block
+
+    def pop(self):
+        block = self[-1]
+        self.cache.pop(len(self) - 1, None)
+        self.store.truncate(len(self) - 1)
+        return block
+
+if __name__ == '__main__':
+    from blockchain import Block
+    from elliptic_curve import bitcoin_G
+    import tempfile
+    import time
+
+    directory = tempfile.mkdtemp()
+    store = BlockStore(directory, segment_size=1024, sync_every=4)
+    prev_block_hash = ''
+    blocks = []
+    for height in range(20):
+        block = Block(block_height=height, prev_block_hash=prev_block_hash, transactions=[])
+        block.mine(difficulty=1, block_reward=50, block_reward_receiver=bitcoin_G * (height + 1), iterations=int(1e6))
+        store.append(block)
+        blocks.append(block)
+        prev_block_hash = block.block_hash
+    store.close()
+
+    start_time = time.time()
+    reopened = BlockStore(directory)
+    tip = StoredBlocks(reopened)[-1]
+    print(f'reopened store and read the tip in {round((time.time() - start_time)*1000, 2)}ms')
+    print(f'reopen test passed: {len(reopened) == 20 and tip == blocks[-1] and tip.verify_proof_of_work(difficulty=1)}')
+    print(f'segments rolled over: {len(os.listdir(directory)) > 2}')
+    print(f'hash index test passed: {reopened.hash_index()[blocks[7].block_hash] == 7 and reopened.difficulty(7) == 1}')
+
+    reopened.truncate(15)
+    reopened.append(blocks[15])
+    print(f'truncate and append test passed: {len(reopened) == 16 and reopened.get(15) == blocks[15] and blocks[16].block_hash not in reopened.hash_index()}')
+    reopened.close()
@@ -0,0 +1,275 @@
+from blockchain import EMPTY_HASH
+from collections import OrderedDict
+
+# every valid block we know about, on the main chain or not. the main chain is the branch with
+# the most cumulative proof of work, and switching to a heavier branch only disconnects and
+# reconnects the blocks after the fork point.
+
+# results of BlockTree.add
+EXTENDED = 'extended' # the block (or orphans it completed) extended the main chain
+REORG = 'reorg' # the main chain switched to another branch
+SIDE = 'side' # stored on a branch with less work than the main chain
+ORPHAN = 'orphan' # parent unknown, held until it arrives
+DUPLICATE = 'duplicate'
+INVALID = 'invalid' # height doesn't follow its parent, it failed can_connect or it builds on a block that did
+
+def block_work(difficulty):
+    # expected number of hashes to find a block hash starting with `difficulty` hex zeros
+    return 16 ** difficulty
+
+class BlockEntry:
+    def __init__(self, block_hash, parent, block_height, work):
+        self.block_hash = block_hash
+        self.parent = parent # BlockEntry, None for genesis
+        self.block_height = block_height
+        self.work = work # cumulative, from genesis up to and including this block
+        self.in_main_chain = False
+        self.invalid = False # failed can_connect when its branch was switched to
+        self.block = None # kept only while off the main chain, the blockchain holds main chain blocks
+
+class BlockTree:
+    '''
+    Block index over a Blockchain: block_hash -> BlockEntry with parent pointers and cumulative
+    work, plus an orphan pool for blocks whose parent hasn't arrived yet. The Blockchain always
+    holds the heaviest known branch. on_connect(block) and on_disconnect(block) are called for
+    every block that joins or leaves the main chain, e.g. to update the mempool.
+
+    can_connect(block) is asked before each block joins the main chain, with on_connect already
+    called for its parent, and returns why the block can't be connected or None. Side branches
+    are only checked when they are switched to, and a failing block aborts the switch: the old
+    branch is restored and the block and its descendants are marked invalid. Reorgs that would
+    disconnect more than max_reorg_depth blocks are refused, e.g. deeper than the undo records
+    on_disconnect relies on.
+    '''
+    def __init__(self, blockchain, on_connect=None, on_disconnect=None, can_connect=None, max_reorg_depth=None, max_orphans=100):
+        self.blockchain = blockchain
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.can_connect = can_connect
+        self.max_reorg_depth = max_reorg_depth
+        self.max_orphans = max_orphans
+
+        self.entries = {} # block_hash -> BlockEntry
+        self.orphans = OrderedDict() # block_hash -> block
+        self.orphans_by_parent = {} # prev_block_hash -> [block_hash]
+        self.tip = None
+        self.reorgs = 0
+        self.last_reorg_depth = 0
+        self.refused_reorgs = 0
+        self.last_rejection = None # why the last INVALID block was rejected
+
+        # from the store's index for a stored chain, without decoding any block
+        for block_hash, block_height, difficulty in blockchain.block_summaries():
+            entry = self._new_entry(block_hash, block_height, difficulty, self.tip)
+            entry.in_main_chain = True
+            self.tip = entry
+
+    def __contains__(self, block_hash):
+        return block_hash in self.entries
+
+    def _new_entry(self, block_hash, block_height, difficulty, parent):
+        work = (parent.work if parent is not None else 0) + block_work(difficulty)
+        entry = BlockEntry(block_hash, parent, block_height, work)
+        self.entries[block_hash] = entry
+        return entry
+
+    def add(self, block):
+        '''
+        Add a block that passed validation. Returns one of EXTENDED, REORG, SIDE, ORPHAN, DUPLICATE, INVALID.
+        '''
+        known = self.entries.get(block.block_hash)
+        if known is not None and known.invalid:
+            self.last_rejection = 'block was rejected before'
+            return INVALID
+        if known is not None or block.block_hash in self.orphans:
+            return DUPLICATE
+
+        is_genesis = block.prev_block_hash in ('', EMPTY_HASH)
+        if not is_genesis and block.prev_block_hash not in self.entries:
+            self._add_orphan(block)
+            return ORPHAN
+
+        old_tip = self.tip
+        reorgs = self.reorgs
+
+        # the block, then any orphans that were waiting for it or for each other
+        pending = [block]
+        while pending:
+            next_block = pending.pop()
+            parent = None if next_block.prev_block_hash in ('', EMPTY_HASH) else self.entries[next_block.prev_block_hash]
+            children = [self.orphans.pop(orphan_hash) for orphan_hash in self.orphans_by_parent.pop(next_block.block_hash, [])]
+
+            if parent is not None and parent.invalid:
+                reason = 'builds on an invalid block'
+            elif next_block.block_height != (parent.block_height + 1 if parent is not None else 0):
+                reason = 'height does not follow its parent'
+            else:
+                reason = None
+            if reason is not None:
+                if next_block is block:
+                    self.last_rejection = reason
+                    return INVALID
+                continue # an orphan that doesn't fit, drop it and the orphans built on it
+
+            entry = self._new_entry(next_block.block_hash, next_block.block_height, next_block.difficulty, parent)
+            entry.block = next_block
+            if self.tip is None or entry.work > self.tip.work:
+                self._switch_tip(entry)
+            if entry.invalid and next_block is block:
+                return INVALID
+            pending += children
+
+        if self.tip is old_tip:
+            return SIDE
+        return REORG if self.reorgs != reorgs else EXTENDED
+
+    def _add_orphan(self, block):
+        self.orphans[block.block_hash] = block
+        self.orphans_by_parent.setdefault(block.prev_block_hash, []).append(block.block_hash)
+        while len(self.orphans) > self.max_orphans:
+            orphan_hash, orphan = self.orphans.popitem(last=False)
+            siblings = self.orphans_by_parent[orphan.prev_block_hash]
+            siblings.remove(orphan_hash)
+            if not siblings:
+                del self.orphans_by_parent[orphan.prev_block_hash]
+
+    def _disconnect_tip(self):
+        block = self.blockchain.remove_block()
+        self.tip.block = block
+        self.tip.in_main_chain = False
+        if self.on_disconnect is not None:
+            self.on_disconnect(block)
+        self.tip = self.tip.parent
+
+    def _connect(self, entry):
+        self.blockchain.add_block(entry.block)
+        entry.in_main_chain = True
+        if self.on_connect is not None:
+            self.on_connect(entry.block)
+        entry.block = None
+        self.tip = entry
+
+    def _switch_tip(self, new_tip):
+        # the new branch back to the fork point, O(fork depth). returns True if the main chain switched to it
+        branch = []
+        fork = new_tip
+        while fork is not None and not fork.in_main_chain:
+            if fork.invalid:
+                self._mark_invalid(branch, 'builds on an invalid block')
+                return False
+            branch.append(fork)
+            fork = fork.parent
+
+        depth = self.tip.block_height - (fork.block_height if fork is not None else -1) if self.tip is not None else 0
+        if self.max_reorg_depth is not None and depth > self.max_reorg_depth:
+            self.refused_reorgs += 1
+            print(f'refusing a reorg of {depth} blocks, more than the limit of {self.max_reorg_depth}.')
+            return False
+
+        disconnected = []
+        while self.tip is not fork:
+            disconnected.append(self.tip)
+            self._disconnect_tip()
+
+        for position in reversed(range(len(branch))):
+            entry = branch[position]
+            reason = self.can_connect(entry.block) if self.can_connect is not None else None
+            if reason is not None:
+                # abort: back to the fork point, then reconnect the old branch
+                while self.tip is not fork:
+                    self._disconnect_tip()
+                for old_entry in reversed(disconnected):
+                    self._connect(old_entry)
+                self._mark_invalid(branch[:position + 1], reason)
+                return False
+            self._connect(entry)
+
+        if disconnected:
+            self.reorgs += 1
+            self.last_reorg_depth = len(disconnected)
+        return True
+
+    def _mark_invalid(self, entries, reason):
+        # entries off the main chain that failed can_connect, or build on one that did
+        for entry in entries:
+            entry.invalid = True
+            entry.block = None
+        self.last_rejection = reason
+
+if __name__ == '__main__':
+    from blockchain import Block, Blockchain
+    from transaction import Transaction
+    from mempool import Mempool
+    from elliptic_curve import bitcoin_G
+
+    def mine_on(parent, transactions=[], reward_receiver=42):
+        block = Block(block_height=parent.block_height + 1 if parent else 0,
+                      prev_block_hash=parent.block_hash if parent else '',
+                      transactions=list(transactions))
+        block.mine(difficulty=1, block_reward=50, block_reward_receiver=bitcoin_G * reward_receiver, iterations=int(1e6))
+        return block
+
+    mempool = Mempool()
+    chain = Blockchain(block_size=10)
+    tree = BlockTree(chain,
+                     on_connect=lambda block: mempool.remove_confirmed(block.transactions),
+                     on_disconnect=lambda block: [mempool.add(tx) for tx in block.transactions if tx.sender_pk is not None])
+
+    tx = Transaction(sender_pk=bitcoin_G * 5, receiver_pk=bitcoin_G * 6, amount=1, fee=1)
+    tx.sign(sk=5)
+
+    genesis = mine_on(None)
+    a1 = mine_on(genesis, reward_receiver=43)
+    a2 = mine_on(a1, [tx], reward_receiver=44)
+    statuses = [tree.add(block) for block in [genesis, a1, a2]]
+    print(f'main chain test passed: {statuses == [EXTENDED] * 3 and chain.transaction_in_chain(tx) and len(mempool) == 0}')
+
+    b2 = mine_on(a1, reward_receiver=45)
+    b3 = mine_on(b2, reward_receiver=46)
+    b4 = mine_on(b3, reward_receiver=47)
+    print(f'side branch test passed: {tree.add(b2) == SIDE and chain.blocks[-1] == a2}')
+    print(f'orphan test passed: {tree.add(b4) == ORPHAN and len(tree.orphans) == 1}')
+
+    status = tree.add(b3) # completes b4, the b branch now has more work
+    print(f'reorg test passed: {status == REORG and tree.last_reorg_depth == 1 and chain.blocks[-1] == b4 and len(chain.blocks) == 5}')
+    print(f'indexes and mempool updated: {not chain.transaction_in_chain(tx) and tx in mempool and a2.block_hash not in chain.block_index}')
+    print(f'duplicate test passed: {tree.add(a2) == DUPLICATE}')
+
+    # spends are only checked once a branch is switched to. a heavier branch with an unfunded spend is rejected
+    from state import BalanceState
+    balances = BalanceState(max_undo=3)
+    state_chain = Blockchain(block_size=10)
+    state_tree = BlockTree(state_chain, on_connect=balances.apply_block, on_disconnect=balances.undo_block,
+                     can_connect=lambda block: balances.check_block(block, state_chain), max_reorg_depth=balances.max_undo)
+    overspend = Transaction(sender_pk=bitcoin_G * 5, receiver_pk=bitcoin_G * 6, amount=1000, fee=0)
+    overspend.sign(sk=5)
+
+    genesis = mine_on(None, reward_receiver=5)
+    a1 = mine_on(genesis)
+    b1 = mine_on(genesis, [overspend])
+    b2 = mine_on(b1)
+    statuses = [state_tree.add(block) for block in [genesis, a1, b1, b2]]
+    print(f'unfunded branch rejected: {statuses == [EXTENDED, EXTENDED, SIDE, INVALID] and state_chain.blocks[-1] == a1 and balances.tip == a1.block_hash and balances.balance(bitcoin_G * 5) == 50}')
+    print(f'descendants of an invalid block rejected: {state_tree.add(mine_on(b2)) == INVALID and state_tree.add(b1) == INVALID}')
+
+    main_branch = [a1]
+    for _ in range(4):
+        main_branch.append(mine_on(main_branch[-1]))
+        state_tree.add(main_branch[-1])
+    deep_fork = [mine_on(genesis, reward_receiver=50)] # forks 5 blocks below the tip, past the 3 undo records
+    for _ in range(5):
+        deep_fork.append(mine_on(deep_fork[-1], reward_receiver=50))
+    statuses = [state_tree.add(block) for block in deep_fork]
+    print(f'reorg deeper than the undo records refused: {SIDE in statuses and REORG not in statuses and state_tree.refused_reorgs > 0 and state_chain.blocks[-1] == main_branch[-1] and balances.tip == main_branch[-1].block_hash}')
+
+    # a stored chain is indexed from the store without decoding any block
+    from block_store import BlockStore
+    import tempfile
+    directory = tempfile.mkdtemp()
+    store = BlockStore(directory)
+    for block in chain.blocks:
+        store.append(block)
+    store.close()
+    stored_chain = Blockchain(block_size=10, store=BlockStore(directory))
+    stored_tree = BlockTree(stored_chain)
+    print(f'stored chain test passed: {len(stored_chain.blocks.cache) == 0 and stored_tree.tip.block_hash == b4.block_hash and stored_tree.tip.work == tree.tip.work}')
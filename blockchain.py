@@ -1,72 +1,138 @@
 from hash_functions import sha256
-from ecdsa import Transaction
+from transaction import Transaction, verify_signatures
+from mining import search_nonces
+from merkle import merkle_root
+from consensus_parameters import BLOCK_VERSION
+from validation import BlockValidator
 import random
-from elliptic_curve import bitcoin_G, bitcoin_curve
+import struct
+from elliptic_curve import bitcoin_G
+
+EMPTY_HASH = '00'*32 # prev_block_hash of the genesis block, merkle root of a block without transactions
+MAX_DIFFICULTY = 64 # hex digits in a block hash. difficulty comes from peers, anything above this is invalid
+
+class BlockHeader:
+    '''
+    Fixed-size binary block header. This is all that gets hashed for proof of work, the
+    transactions are committed to through the merkle root of their tx_ids.
+    Layout (little endian, 88 bytes): version, prev block hash, merkle root, height, difficulty, nonce.
+    '''
+    FORMAT = struct.Struct('<I32s32sQIQ')
+    SIZE = FORMAT.size
+
+    def __init__(self, version, prev_block_hash, merkle_root, block_height, difficulty, nonce=0):
+        self.version = version
+        self.prev_block_hash = prev_block_hash or EMPTY_HASH # hex strings, like Block.block_hash
+        self.merkle_root = merkle_root
+        self.block_height = block_height
+        self.difficulty = difficulty # number of leading hex zeros the block hash needs
+        self.nonce = nonce
+
+    def serialize(self):
+        return self.FORMAT.pack(self.version,
+                                bytes.fromhex(self.prev_block_hash),
+                                bytes.fromhex(self.merkle_root),
+                                self.block_height,
+                                self.difficulty,
+                                self.nonce)
+
+    def serialize_prefix(self):
+        # everything but the trailing 8 byte nonce, the constant part while mining
+        return self.serialize()[:-8]
+
+    @classmethod
+    def deserialize(cls, data):
+        version, prev_block_hash, merkle_root, block_height, difficulty, nonce = cls.FORMAT.unpack(data)
+        return cls(version, prev_block_hash.hex(), merkle_root.hex(), block_height, difficulty, nonce)
+
+    def hash(self):
+        return sha256(self.serialize(), return_hex=True)
 
 class Block:
     def __init__(self, block_height=None, prev_block_hash='', transactions=[]):
+        self.version = BLOCK_VERSION
         self.block_height = block_height
         self.prev_block_hash = prev_block_hash
         self.transactions = transactions
         
+        self.difficulty = None
         self.proof_of_work = None
         self.block_hash = None
 
-    def aggregate_tx_data(self):
-        # concatenate all transaction data into a string to be hashed
-        transaction_data = ''.join([str(tx.sender_pk.x if tx.sender_pk is not None else None) +
-                            str(tx.receiver_pk.x) + 
-                            str(tx.amount) +
-                            str(tx.message) +
-                            str(tx.signature[0] if tx.signature is not None else None) +
-                            str(tx.signature[1] if tx.signature is not None else None) for tx in self.transactions])
-        
-        return transaction_data
+    def merkle_root(self):
+        if len(self.transactions) == 0:
+            return EMPTY_HASH
+
+        return merkle_root([tx.tx_id for tx in self.transactions])
 
-    def verify_tx_signatures(self):
-        return all(transaction.verify_signature() for transaction in self.transactions)
+    def header(self):
+        return BlockHeader(version=self.version,
+                           prev_block_hash=self.prev_block_hash,
+                           merkle_root=self.merkle_root(),
+                           block_height=self.block_height,
+                           difficulty=self.difficulty,
+                           nonce=self.proof_of_work or 0)
+
+    def verify_tx_signatures(self, batch=True):
+        # a passing batch check covers every transaction. if it fails, check one by one to find the bad signature
+        if batch and verify_signatures(self.transactions):
+            return True
+        return all(transaction.verify_signature(count_lookup=not batch) for transaction in self.transactions)
 
     def verify_proof_of_work(self, difficulty):
-        transaction_data = self.aggregate_tx_data()
-        
-        block_data_w_pow = self.prev_block_hash + transaction_data + str(self.proof_of_work)
-        block_hash = sha256(block_data_w_pow.encode('utf-8'), return_hex=True)
+        if self.proof_of_work is None or self.difficulty is None:
+            return False # block was never mined
+
+        # rebuilding the header recomputes the merkle root, so this also checks the transactions
+        block_hash = self.header().hash()
         
         valid_hash = (block_hash == self.block_hash)
-        valid_pow = block_hash.startswith('0'*difficulty)
+        valid_pow = difficulty <= self.difficulty <= MAX_DIFFICULTY and block_hash.startswith('0'*self.difficulty)
 
         return valid_hash & valid_pow
     
-    def mine(self, difficulty, block_reward, block_reward_receiver, iterations):
-        block_reward_tx = Transaction(
-              sender_pk=None, 
-              receiver_pk=block_reward_receiver, 
-              amount=block_reward,
-              fee=0
-            )
-        
-        self.transactions += [block_reward_tx]
+    def mine(self, difficulty, block_reward, block_reward_receiver, iterations, engine=None, cancel_event=None):
+        '''
+        Search for a proof of work. With a mining.MiningEngine the nonce space is split across
+        its worker processes, otherwise the search runs in the calling thread.
+        Setting cancel_event (e.g. when a better block template arrives) stops the search early.
+        Calling mine again after an unsuccessful search continues on the same block reward.
+        '''
+        def is_reward(tx):
+            return tx.sender_pk is None and tx.receiver_pk == block_reward_receiver and tx.block_height == self.block_height
 
-        transaction_data = self.aggregate_tx_data()
+        if not any(is_reward(tx) for tx in self.transactions):
+            block_reward_tx = Transaction(
+                  sender_pk=None, 
+                  receiver_pk=block_reward_receiver, 
+                  amount=block_reward,
+                  fee=0,
+                  block_height=self.block_height
+                )
+            
+            # any other unsigned transaction would fail validation, so it can't be mined
+            self.transactions = [tx for tx in self.transactions if tx.sender_pk is not None] + [block_reward_tx]
+        self.difficulty = difficulty
+
+        # the header is fixed size, so every attempt costs the same no matter how many transactions the block has
+        header_prefix = self.header().serialize_prefix()
 
-        block_data = self.prev_block_hash + transaction_data
+        start = random.randint(0, 2**64 - 1 - iterations) # random start so repeated searches don't overlap
+        if engine is not None:
+            solution = engine.search(header_prefix, difficulty, start, iterations, cancel_event=cancel_event)
+        else:
+            nonce, block_hash, _ = search_nonces(header_prefix, difficulty, start, start + iterations, stop_event=cancel_event)
+            solution = (nonce, block_hash) if nonce is not None else None
 
-        block_hash = ''
-        for _ in range(iterations):
-            pow = random.randint(1, bitcoin_curve.n - 1)
-            block_data_w_pow = block_data + str(pow)
-            block_hash = sha256(block_data_w_pow.encode('utf-8'), return_hex=True)
-            if block_hash.startswith('0'*difficulty): # if pow found
-                self.proof_of_work = pow
-                self.block_hash = block_hash
-                return True
+        if solution is not None: # if pow found
+            self.proof_of_work, self.block_hash = solution
+            return True
             
         return False
     
     def __hash__(self):
         if self.block_hash is None:
-            transaction_data = self.aggregate_tx_data()
-            return hash(transaction_data)
+            return hash(self.merkle_root())
         else:
             return hash(self.block_hash)
     
@@ -75,39 +141,94 @@ class Block:
             return False
         
         if self.block_hash is None and other.block_hash is None:
-            return self.aggregate_tx_data() == other.aggregate_tx_data()
+            return self.merkle_root() == other.merkle_root()
         elif self.block_hash is not None and other.block_hash is not None:
             return self.block_hash == other.block_hash
         else:
             return False
 
 class Blockchain:
-    def __init__(self, block_size):
-        self.blocks = []
+    def __init__(self, block_size, store=None):
         self.block_size = block_size # number of transactions limit per block
+        self.store = store # optional block_store.BlockStore the chain is kept in
 
-    def verify_blockchain(self, difficulty):
-        block_heights = [block.block_height for block in self.blocks]
-        if not all(x + 1 == y for x, y in zip(block_heights, block_heights[1:])):
-            print(block_heights)
-            return False
+        if store is None:
+            self.blocks = []
+            self.block_index = {} # block_hash -> block_height
+        else:
+            from block_store import StoredBlocks # block_store imports codec, which imports this module
+            # blocks are read from disk on demand. a stored chain starts at genesis, so heights are positions
+            self.blocks = StoredBlocks(store)
+            self.block_index = store.hash_index()
+
+        # tx_id -> (block_height, index in block), kept up to date by add_block / remove_block.
+        # built on first use, so a stored chain can start serving without decoding every block
+        self._tx_index = None if store is not None else {}
+
+    @property
+    def tx_index(self):
+        if self._tx_index is None:
+            self._tx_index = {tx.tx_id: (block.block_height, index)
+                              for block in self.blocks for index, tx in enumerate(block.transactions)}
+        return self._tx_index
+
+    def add_block(self, block):
+        # append a block that extends the tip
+        self.blocks.append(block)
+        self.block_index[block.block_hash] = block.block_height
+        if self._tx_index is not None:
+            for index, tx in enumerate(block.transactions):
+                self._tx_index[tx.tx_id] = (block.block_height, index)
+
+    def remove_block(self):
+        # disconnect the tip block, e.g. during a reorg
+        block = self.blocks.pop()
+        self.block_index.pop(block.block_hash, None)
+        if self._tx_index is not None:
+            for tx in block.transactions:
+                if self._tx_index.get(tx.tx_id, (None, None))[0] == block.block_height:
+                    del self._tx_index[tx.tx_id]
+        return block
+
+    def get_block(self, block_height):
+        if len(self.blocks) == 0:
+            return None
+        position = block_height - self.blocks[0].block_height
+        if not 0 <= position < len(self.blocks):
+            return None
+        return self.blocks[position]
+
+    def block_summaries(self):
+        # (block_hash, block_height, difficulty) for every block, from the store's index when there is one
+        if self.store is not None:
+            return [(self.store.block_hash(height), height, self.store.difficulty(height)) for height in range(len(self.store))]
+        return [(block.block_hash, block.block_height, block.difficulty) for block in self.blocks]
 
-        # all sigs and pow are valid
-        for block in self.blocks:
-            if not (block.verify_proof_of_work(difficulty=difficulty) & block.verify_tx_signatures()):
-                print('here')
-                print(block.__dict__)
+    def get_block_by_hash(self, block_hash):
+        block_height = self.block_index.get(block_hash)
+        return None if block_height is None else self.get_block(block_height)
+
+    def get_transaction(self, tx_id):
+        location = self.tx_index.get(tx_id)
+        if location is None:
+            return None
+        block_height, index = location
+        return self.get_block(block_height).transactions[index]
+
+    def verify_blockchain(self, difficulty, workers=1):
+        # staged validation of the whole chain from genesis, stopping at the first invalid block
+        validator = BlockValidator(difficulty=difficulty, block_size=self.block_size, workers=workers)
+        reasons = validator.validate(list(self.blocks))
+        validator.close()
+
+        for block, reason in zip(self.blocks, reasons):
+            if reason is not None:
+                print(f'block {block.block_height} is invalid: {reason}')
                 return False
-            
         return True
     
     def transaction_in_chain(self, transaction):
-        # simple but inefficient way to do this
-        for block in self.blocks:
-            for tx in block.transactions:
-                if tx == transaction.tx_id:
-                    return True
-        return False
+        return transaction.tx_id in self.tx_index
     
     def __hash__(self):
         if len(self.blocks)==0:
@@ -139,13 +260,16 @@ if __name__ == '__main__':
                           transactions=[])
 
     import time
+    from mining import MiningEngine
     start_time = time.time()
 
-    print('mining block...')
+    engine = MiningEngine()
+    print(f'mining block with {engine.workers} workers...')
     solved = genesis_block.mine(difficulty=12, 
                        block_reward_receiver=bitcoin_G*42,
                        block_reward=50,
-                       iterations=int(2e6))
+                       iterations=int(2e6),
+                       engine=engine)
     
     end_time = time.time()
 
@@ -158,4 +282,24 @@ if __name__ == '__main__':
         print(f"took {round(elapsed_time,2)} seconds")
     else:
         print('not found.')
-        print(f"took {round(elapsed_time,2)} seconds")
\ No newline at end of file
+        print(f"took {round(elapsed_time,2)} seconds")
+    print(f"hashrate {round(engine.hashrate)} hashes/second")
+    engine.close()
+
+    # every block reward paid to the same key gets its own tx_id, so the index keeps all of them
+    chain = Blockchain(block_size=10)
+    prev_block_hash = ''
+    for height in range(3):
+        block = Block(block_height=height, prev_block_hash=prev_block_hash, transactions=[])
+        block.mine(difficulty=1, block_reward=50, block_reward_receiver=bitcoin_G*42, iterations=int(1e6))
+        chain.add_block(block)
+        prev_block_hash = block.block_hash
+    rewards = [block.transactions[0] for block in chain.blocks]
+    chain.remove_block()
+    print(f'block reward index test passed: {len(set(tx.tx_id for tx in rewards)) == 3 and chain.transaction_in_chain(rewards[0]) and chain.transaction_in_chain(rewards[1])}')
+
+    # an unsigned transaction that isn't this block's reward doesn't stop the reward being added
+    stray = Transaction(sender_pk=None, receiver_pk=bitcoin_G*7, amount=50, fee=0)
+    block = Block(block_height=5, prev_block_hash=prev_block_hash, transactions=[stray])
+    block.mine(difficulty=1, block_reward=50, block_reward_receiver=bitcoin_G*42, iterations=int(1e6))
+    print(f'block reward test passed: {[(tx.receiver_pk == bitcoin_G*42, tx.block_height) for tx in block.transactions] == [(True, 5)]}')
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+import time
+
+class SeenCache:
+    '''
+    Bounded set of recently seen message hashes (tx_id or block hash) for gossip duplicate
+    suppression. O(1) lookups, least recently seen entries are dropped past max_size and,
+    if max_age is set, entries older than max_age seconds count as unseen.
+    '''
+    def __init__(self, max_size=100000, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries = OrderedDict() # hash -> time last seen
+
+        self.hits = 0 # duplicates suppressed
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        seen_at = self.entries.get(key)
+        return seen_at is not None and (self.max_age is None or time.time() - seen_at <= self.max_age)
+
+    def check(self, key):
+        # True if key was seen before (a duplicate), without recording it
+        duplicate = key in self
+        if duplicate:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return duplicate
+
+    def add(self, key):
+        self.entries[key] = time.time()
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def check_and_add(self, key):
+        # True if key was seen before (a duplicate), and records it as seen either way
+        duplicate = self.check(key)
+        self.add(key)
+        return duplicate
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+class SignatureCache:
+    '''
+    Bounded record of signatures that passed ECDSA verification, keyed by (tx_id, signature,
+    sender public key). A transaction is verified once when it reaches the mempool, and the
+    blocks that include it can then skip it. Only successes are stored, so a cache hit always
+    means the signature is valid. Least recently used entries are dropped past max_size.
+    '''
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict() # key -> None
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(tx):
+        return (tx.tx_id, tx.signature, tx.sender_pk.x, tx.sender_pk.y)
+
+    def check(self, tx):
+        # True if tx's signature was verified before
+        key = self.key(tx)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True
+        self.misses += 1
+        return False
+
+    def contains(self, tx):
+        # check without counting, for a transaction whose lookup was already counted by the caller
+        return self.key(tx) in self.entries
+
+    def add(self, tx):
+        key = self.key(tx)
+        self.entries[key] = None
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
@@ -0,0 +1,444 @@
+from transaction import Transaction
+from blockchain import Block, BlockHeader, EMPTY_HASH
+from relay import Inventory, GetData, CompactBlock, GetBlockTransactions, BlockTransactions, SHORT_ID_SIZE
+from sync import GetHeaders, Headers
+from spv import GetMerkleProof, MerkleProof
+from merkle import HASH_SIZE
+from elliptic_curve import bitcoin_curve, lift_x
+import functools
+import math
+import struct
+
+# binary wire format for peer messages, replacing pickled (message, port) tuples.
+# every message is: codec version (1 byte), message type (1 byte), sender port (2 bytes), payload.
+# decoding never executes code from the peer, it only reads the fields below.
+CODEC_VERSION = 1
+
+ENVELOPE = struct.Struct('>BBH')
+BLOCK_FIELDS = struct.Struct('<I32sQIQ') # version, prev block hash, height, difficulty, nonce
+FLOAT = struct.Struct('>d')
+
+# number tags, amounts and fees can be ints or floats
+_UINT, _NEGATIVE_INT, _FLOAT = 0, 1, 2
+
+class Encoder:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+
+    def write_byte(self, value):
+        self.buffer.append(value)
+
+    def write_varint(self, value):
+        # unsigned LEB128, 7 bits per byte with the high bit set on every byte but the last
+        if value < 0:
+            raise ValueError("varints are unsigned.")
+        while value >= 0x80:
+            self.buffer.append((value & 0x7f) | 0x80)
+            value >>= 7
+        self.buffer.append(value)
+
+    def write_int256(self, value):
+        self.buffer += value.to_bytes(32, byteorder='big')
+
+    def write_number(self, value):
+        if isinstance(value, int):
+            if value >= 0:
+                self.write_byte(_UINT)
+                self.write_varint(value)
+            else:
+                self.write_byte(_NEGATIVE_INT)
+                self.write_varint(-value)
+        else:
+            self.write_byte(_FLOAT)
+            self.write(FLOAT.pack(value))
+
+    def write_public_key(self, point):
+        # compressed sec format, 0x02/0x03 by y parity followed by x. a single 0x00 byte for no key
+        if point is None:
+            self.write_byte(0)
+            return
+        self.write_byte(3 if point.y & 1 else 2)
+        self.write_int256(point.x)
+
+    def write_hash(self, hex_hash):
+        self.buffer += bytes.fromhex(hex_hash)
+
+class Decoder:
+    '''
+    Reads fields straight out of a memoryview of the received message, without copying it.
+    '''
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset + size > len(self.view):
+            raise ValueError("Message is truncated.")
+        chunk = self.view[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+    def read_byte(self):
+        return self.read(1)[0]
+
+    def read_struct(self, fmt):
+        return fmt.unpack(self.read(fmt.size))
+
+    def read_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+            if shift > 7*40:
+                raise ValueError("varint is too long.")
+
+    def read_int256(self):
+        return int.from_bytes(self.read(32), byteorder='big')
+
+    def read_number(self):
+        tag = self.read_byte()
+        if tag == _UINT:
+            return self.read_varint()
+        if tag == _NEGATIVE_INT:
+            return -self.read_varint()
+        if tag == _FLOAT:
+            return self.read_struct(FLOAT)[0]
+        raise ValueError(f"Unknown number tag {tag}.")
+
+    def read_public_key(self):
+        prefix = self.read_byte()
+        if prefix == 0:
+            return None
+        if prefix not in (2, 3):
+            raise ValueError(f"Unknown public key prefix {prefix}.")
+        return _decompress_public_key(self.read_int256(), prefix == 3)
+
+    def read_hash(self):
+        return self.read(32).hex()
+
+    def done(self):
+        return self.offset == len(self.view)
+
+@functools.lru_cache(maxsize=4096)
+def _decompress_public_key(x, odd):
+    # a modular square root per key, cached since a block's keys were usually just seen in its transactions
+    point = lift_x(x, bitcoin_curve, odd=odd)
+    if point is None:
+        raise ValueError("Public key is not on the curve.")
+    return point
+
+def encode_transaction(encoder, tx):
+    encoder.write_public_key(tx.sender_pk)
+    encoder.write_public_key(tx.receiver_pk)
+    encoder.write_number(tx.amount)
+    encoder.write_number(tx.tx_fee)
+    if tx.signature is not None:
+        encoder.write_byte(1)
+        encoder.write_int256(tx.signature[0]) # fixed width r and s
+        encoder.write_int256(tx.signature[1])
+    elif tx.block_height is not None:
+        encoder.write_byte(2) # block reward, committed to the height of its block
+        encoder.write_varint(tx.block_height)
+    else:
+        encoder.write_byte(0)
+
+def decode_transaction(decoder):
+    sender_pk = decoder.read_public_key()
+    receiver_pk = decoder.read_public_key()
+    if receiver_pk is None:
+        raise ValueError("Transaction has no receiver.")
+
+    amount = decoder.read_number()
+    fee = decoder.read_number()
+    if not (math.isfinite(amount) and math.isfinite(fee)):
+        raise ValueError("Transaction amount and fee must be finite.")
+    kind = decoder.read_byte()
+    if kind not in (0, 1, 2):
+        raise ValueError(f"Unknown transaction kind {kind}.")
+    tx = Transaction(sender_pk=sender_pk,
+                     receiver_pk=receiver_pk,
+                     amount=amount,
+                     fee=fee,
+                     block_height=decoder.read_varint() if kind == 2 else None)
+    if kind == 1:
+        tx.set_signature((decoder.read_int256(), decoder.read_int256())) # recomputes the tx_id
+    return tx
+
+def encode_block(encoder, block):
+    mined = block.block_hash is not None
+    encoder.write(BLOCK_FIELDS.pack(block.version,
+                                    bytes.fromhex(block.prev_block_hash or EMPTY_HASH),
+                                    block.block_height or 0,
+                                    block.difficulty or 0,
+                                    block.proof_of_work or 0))
+    encoder.write_byte(mined)
+    if mined:
+        encoder.write_hash(block.block_hash)
+
+    encoder.write_varint(len(block.transactions))
+    for tx in block.transactions:
+        encode_transaction(encoder, tx)
+
+def decode_block(decoder):
+    version, prev_block_hash, block_height, difficulty, nonce = decoder.read_struct(BLOCK_FIELDS)
+    prev_block_hash = prev_block_hash.hex()
+    block = Block(block_height=block_height,
+                  prev_block_hash='' if prev_block_hash == EMPTY_HASH else prev_block_hash,
+                  transactions=[])
+    block.version = version
+
+    if decoder.read_byte():
+        block.difficulty = difficulty
+        block.proof_of_work = nonce
+        block.block_hash = decoder.read_hash() # checked against the header by verify_proof_of_work
+
+    for _ in range(decoder.read_varint()):
+        block.transactions.append(decode_transaction(decoder))
+    return block
+
+def encode_hashes(encoder, hashes):
+    encoder.write_varint(len(hashes))
+    for hex_hash in hashes:
+        encoder.write_hash(hex_hash)
+
+def decode_hashes(decoder):
+    return [decoder.read_hash() for _ in range(decoder.read_varint())]
+
+def encode_inventory(encoder, message):
+    encoder.write_byte(message.kind)
+    encode_hashes(encoder, message.hashes)
+
+def decode_inventory(cls):
+    def decode(decoder):
+        return cls(decoder.read_byte(), decode_hashes(decoder))
+    return decode
+
+def encode_compact_block(encoder, message):
+    encoder.write(BLOCK_FIELDS.pack(message.version,
+                                    bytes.fromhex(message.prev_block_hash or EMPTY_HASH),
+                                    message.block_height,
+                                    message.difficulty,
+                                    message.proof_of_work))
+    encoder.write_hash(message.block_hash)
+    encoder.write_hash(message.merkle_root)
+
+    encoder.write_varint(len(message.short_ids))
+    for short_id in message.short_ids:
+        encoder.write(short_id)
+
+    encoder.write_varint(len(message.prefilled))
+    for index, tx in message.prefilled:
+        encoder.write_varint(index)
+        encode_transaction(encoder, tx)
+
+def decode_compact_block(decoder):
+    version, prev_block_hash, block_height, difficulty, nonce = decoder.read_struct(BLOCK_FIELDS)
+    prev_block_hash = prev_block_hash.hex()
+    block_hash = decoder.read_hash()
+    merkle_root = decoder.read_hash()
+    short_ids = [bytes(decoder.read(SHORT_ID_SIZE)) for _ in range(decoder.read_varint())]
+
+    prefilled = [(decoder.read_varint(), decode_transaction(decoder)) for _ in range(decoder.read_varint())]
+    indexes = set(index for index, _ in prefilled)
+    if len(indexes) != len(prefilled) or any(index >= len(short_ids) + len(prefilled) for index in indexes):
+        raise ValueError("Prefilled transaction indexes are out of range or repeated.")
+
+    return CompactBlock(version, block_height, '' if prev_block_hash == EMPTY_HASH else prev_block_hash,
+                        merkle_root, difficulty, nonce, block_hash, short_ids, prefilled)
+
+def encode_get_block_transactions(encoder, message):
+    encoder.write_hash(message.block_hash)
+    encoder.write_varint(len(message.indexes))
+    for index in message.indexes:
+        encoder.write_varint(index)
+
+def decode_get_block_transactions(decoder):
+    block_hash = decoder.read_hash()
+    return GetBlockTransactions(block_hash, [decoder.read_varint() for _ in range(decoder.read_varint())])
+
+def encode_block_transactions(encoder, message):
+    encoder.write_hash(message.block_hash)
+    encoder.write_varint(len(message.transactions))
+    for tx in message.transactions:
+        encode_transaction(encoder, tx)
+
+def decode_block_transactions(decoder):
+    block_hash = decoder.read_hash()
+    return BlockTransactions(block_hash, [decode_transaction(decoder) for _ in range(decoder.read_varint())])
+
+def encode_get_headers(encoder, message):
+    encode_hashes(encoder, message.locator)
+    encoder.write_varint(message.count)
+
+def decode_get_headers(decoder):
+    locator = decode_hashes(decoder)
+    return GetHeaders(locator, decoder.read_varint())
+
+def encode_headers(encoder, message):
+    encoder.write_varint(len(message.headers))
+    for header in message.headers:
+        encoder.write(header.serialize())
+
+def decode_headers(decoder):
+    return Headers([BlockHeader.deserialize(decoder.read(BlockHeader.SIZE)) for _ in range(decoder.read_varint())])
+
+def encode_get_merkle_proof(encoder, message):
+    encode_hashes(encoder, message.tx_ids)
+
+def decode_get_merkle_proof(decoder):
+    return GetMerkleProof(decode_hashes(decoder))
+
+def encode_merkle_proof(encoder, message):
+    encoder.write_hash(message.tx_id)
+    encoder.write_hash(message.block_hash)
+    encoder.write_varint(message.index)
+    encoder.write_varint(len(message.proof))
+    for sibling in message.proof:
+        encoder.write(sibling)
+
+def decode_merkle_proof(decoder):
+    tx_id = decoder.read_hash()
+    block_hash = decoder.read_hash()
+    index = decoder.read_varint()
+    proof = [bytes(decoder.read(HASH_SIZE)) for _ in range(decoder.read_varint())]
+    return MerkleProof(tx_id, block_hash, index, proof)
+
+# message type -> (class, encode, decode)
+MESSAGE_TYPES = {}
+
+def register_message(message_type, cls, encode, decode):
+    MESSAGE_TYPES[message_type] = (cls, encode, decode)
+
+register_message(1, Transaction, encode_transaction, decode_transaction)
+register_message(2, Block, encode_block, decode_block)
+register_message(3, Inventory, encode_inventory, decode_inventory(Inventory))
+register_message(4, GetData, encode_inventory, decode_inventory(GetData))
+register_message(5, CompactBlock, encode_compact_block, decode_compact_block)
+register_message(6, GetBlockTransactions, encode_get_block_transactions, decode_get_block_transactions)
+register_message(7, BlockTransactions, encode_block_transactions, decode_block_transactions)
+register_message(8, GetHeaders, encode_get_headers, decode_get_headers)
+register_message(9, Headers, encode_headers, decode_headers)
+register_message(10, GetMerkleProof, encode_get_merkle_proof, decode_get_merkle_proof)
+register_message(11, MerkleProof, encode_merkle_proof, decode_merkle_proof)
+
+def encode_message(message, port):
+    for message_type, (cls, encode, _) in MESSAGE_TYPES.items():
+        if type(message) is cls:
+            encoder = Encoder()
+            encoder.write(ENVELOPE.pack(CODEC_VERSION, message_type, port))
+            encode(encoder, message)
+            return bytes(encoder.buffer)
+    raise TypeError(f"No wire encoding for {type(message).__name__}.")
+
+def decode_message(data):
+    '''
+    Returns (message, sender port). Raises ValueError on anything malformed.
+    '''
+    decoder = Decoder(data)
+    version, message_type, port = decoder.read_struct(ENVELOPE)
+    if version != CODEC_VERSION:
+        raise ValueError(f"Unsupported codec version {version}.")
+    if message_type not in MESSAGE_TYPES:
+        raise ValueError(f"Unknown message type {message_type}.")
+
+    message = MESSAGE_TYPES[message_type][2](decoder)
+    if not decoder.done():
+        raise ValueError("Trailing bytes after message.")
+    return message, port
+
+if __name__ == '__main__':
+    # round trip checks, and size / speed compared with the pickled tuples this format replaces
+    from elliptic_curve import bitcoin_G
+    from merkle import MerkleTree, verify_proof
+    import pickle
+    import time
+
+    def same_transaction(a, b):
+        return (a.tx_id == b.tx_id and a.signature == b.signature and a.amount == b.amount and a.tx_fee == b.tx_fee
+                and a.sender_pk == b.sender_pk and a.receiver_pk == b.receiver_pk)
+
+    txs = []
+    for sk in range(2, 12):
+        tx = Transaction(sender_pk=bitcoin_G * sk, receiver_pk=bitcoin_G * (sk + 1000), amount=sk, fee=0.00001 * sk)
+        tx.sign(sk=sk)
+        txs.append(tx)
+
+    unsigned_tx = Transaction(sender_pk=bitcoin_G * 5, receiver_pk=bitcoin_G * 6, amount=-3, fee=2**70)
+    decoded, port = decode_message(encode_message(unsigned_tx, 43))
+    print(f'unsigned transaction round trip passed: {same_transaction(decoded, unsigned_tx) and port == 43}')
+
+    decoded, _ = decode_message(encode_message(txs[0], 43))
+    print(f'signed transaction round trip passed: {same_transaction(decoded, txs[0]) and decoded.verify_signature()}')
+
+    block = Block(block_height=0, prev_block_hash='', transactions=list(txs))
+    block.mine(difficulty=2, block_reward=50, block_reward_receiver=bitcoin_G * 42, iterations=int(1e6))
+    decoded, port = decode_message(encode_message(block, 5001))
+    print(f'block round trip passed: {decoded == block and port == 5001 and decoded.verify_proof_of_work(difficulty=2) and all(same_transaction(a, b) for a, b in zip(decoded.transactions, block.transactions))}')
+
+    compact, _ = decode_message(encode_message(CompactBlock.from_block(block), 5001))
+    missing = compact.fill({tx.tx_id: tx for tx in txs[1:]})
+    missing = compact.add_missing(txs[:1]) if missing == [0] else missing
+    print(f'compact block round trip passed: {missing == [] and compact.to_block().header().hash() == block.block_hash}')
+    forged = CompactBlock.from_block(block)
+    forged.merkle_root = EMPTY_HASH
+    print(f'compact block header check passed: {compact.verify_header(difficulty=2) and not forged.verify_header(difficulty=2)}')
+
+    tree = MerkleTree([tx.tx_id for tx in block.transactions])
+    proof, _ = decode_message(encode_message(MerkleProof(txs[3].tx_id, block.block_hash, 3, tree.proof(3)), 5001))
+    print(f'merkle proof round trip passed: {verify_proof(proof.tx_id, proof.index, proof.proof, block.merkle_root())}')
+
+    try:
+        decode_message(encode_message(block, 5001)[:-1])
+        print('truncated message rejected: False')
+    except ValueError:
+        print('truncated message rejected: True')
+
+    malformed = bytearray(encode_message(unsigned_tx, 43))
+    malformed[-1] = 9 # the kind byte ends an unsigned transaction
+    try:
+        decode_message(bytes(malformed))
+        print('unknown transaction kind rejected: False')
+    except ValueError:
+        print('unknown transaction kind rejected: True')
+
+    try:
+        decode_message(encode_message(Transaction(sender_pk=bitcoin_G * 5, receiver_pk=bitcoin_G * 6, amount=float('nan'), fee=0), 44))
+        print('non-finite amount rejected: False')
+    except ValueError:
+        print('non-finite amount rejected: True')
+
+    encoded = encode_message(block, 5001)
+    pickled = pickle.dumps((block, 5001))
+    print(f'block with {len(block.transactions)} transactions: {len(encoded)} bytes encoded, {len(pickled)} bytes pickled')
+
+    print(f'compact block: {len(encode_message(CompactBlock.from_block(block), 5001))} bytes encoded')
+
+    encoded_tx = encode_message(txs[0], 43)
+    print(f'transaction: {len(encoded_tx)} bytes encoded, {len(pickle.dumps((txs[0], 43)))} bytes pickled')
+
+    rounds = 200
+    start_time = time.time()
+    for _ in range(rounds):
+        _decompress_public_key.cache_clear()
+        decode_message(encoded)
+    print(f'codec: decode {round((time.time() - start_time) / rounds * 1e6)}us per block with every public key decompressed')
+
+    for name, encode, decode in [('codec', lambda: encode_message(block, 5001), decode_message),
+                                 ('pickle', lambda: pickle.dumps((block, 5001)), pickle.loads)]:
+        start_time = time.time()
+        for _ in range(rounds):
+            data = encode()
+        encode_time = (time.time() - start_time) / rounds
+
+        start_time = time.time()
+        for _ in range(rounds):
+            decode(data)
+        decode_time = (time.time() - start_time) / rounds
+        print(f'{name}: encode {round(encode_time*1e6)}us, decode {round(decode_time*1e6)}us per block')
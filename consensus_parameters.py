@@ -1,3 +1,4 @@
 MINING_DIFFICULTY = 6
 BLOCK_SIZE = 10 # number of transactions per block
-BLOCK_REWARD = 50
\ No newline at end of file
+BLOCK_REWARD = 50
+BLOCK_VERSION = 1 # version field of the binary block header
@@ -1,4 +1,4 @@
-from modular_inverse import inv
+from modular_inverse import inv, inv_many
 
 class Curve:
     """
@@ -68,21 +68,317 @@ class Point():
     def __mul__(self, other):
         '''
         This will be used with giant private keys. Use double and add algorithm for efficiency.
+        The ladder runs in jacobian coordinates so only the final conversion back to affine needs an inversion.
         '''
         if not isinstance(other, int):
             return TypeError("Expected Scalar.")
 
-        track = [(1, self)] # use an external tracker so we have comparators defined '<', '<='
+        return _from_jacobian(self._mul_jacobian(other), self.curve)
 
-        while track[-1][0]*2 < other: # double until the next double exceeds i
-            track.append((track[-1][0]*2, track[-1][1].double()))
+    def _mul_jacobian(self, scalar):
+        if self.x is None or scalar == 0:
+            return _JACOBIAN_IDENTITY
 
-        for int1, point1 in reversed(track): # add doubles in reverse until result is achieved
-            if (track[-1][0] + int1) <= other:
-                track.append((track[-1][0] + int1, track[-1][1] + point1))
+        table = _fixed_base_table(self)
+        if table is not None:
+            return table.multiply(scalar)
 
-        return track[-1][1]
+        p, a = self.curve.p, self.curve.a
+        base = _to_jacobian(self)
+        result = _JACOBIAN_IDENTITY
 
+        for bit in bin(scalar)[2:]: # most significant bit first
+            result = _jacobian_double(result, p, a)
+            if bit == '1':
+                result = _jacobian_add(result, base, p, a)
+        return result
+
+    def mul_many(self, scalars):
+        '''
+        [self * scalar for scalar in scalars], e.g. public keys for many private keys.
+        All the results are converted back to affine together, with a single inversion.
+        '''
+        results = _normalize_many([self._mul_jacobian(scalar) for scalar in scalars], self.curve.p)
+        return [Point(X, Y, self.curve) if Z else Point(None, None, self.curve) for X, Y, Z in results]
+
+    @staticmethod
+    def multi_mul(terms, window=5):
+        '''
+        Sum of point * scalar over (point, scalar) pairs, e.g. u1*G + u2*Q for signature verification.
+        Points with a fixed-base table are looked up directly, the rest are interleaved
+        wNAF (Strauss/Shamir's trick) so they share a single doubling chain.
+        '''
+        terms = list(terms)
+        if not terms:
+            raise ValueError("Expected at least one (point, scalar) pair.")
+
+        curve = terms[0][0].curve
+        p, a = curve.p, curve.a
+        result = _JACOBIAN_IDENTITY
+        interleaved = []
+
+        for point, scalar in terms:
+            if not isinstance(point, Point):
+                raise TypeError("Unsupported operand type. Expected Point object.")
+            if point.curve != curve:
+                raise ValueError("Cannot add points on different curves.")
+            if point.x is None or scalar == 0:
+                continue
+
+            table = _fixed_base_table(point)
+            if table is not None:
+                result = _jacobian_add(result, table.multiply(scalar), p, a)
+                continue
+
+            base = _to_jacobian(point)
+            if scalar < 0:
+                base = _jacobian_negate(base, p)
+                scalar = -scalar
+            interleaved.append((base, scalar))
+
+        if 0 < len(interleaved) <= _PIPPENGER_THRESHOLD:
+            interleaved = [(_wnaf(scalar, window), _odd_multiples(base, window, p, a)) for base, scalar in interleaved]
+
+        if len(interleaved) > _PIPPENGER_THRESHOLD:
+            # bucket method, cheaper than one precomputed table per point for large batches
+            result = _jacobian_add(result, _pippenger(interleaved, p, a), p, a)
+        elif interleaved:
+            acc = _JACOBIAN_IDENTITY
+            for i in reversed(range(max(len(digits) for digits, _ in interleaved))):
+                acc = _jacobian_double(acc, p, a)
+                for digits, odd_multiples in interleaved:
+                    if i < len(digits) and digits[i]:
+                        digit = digits[i]
+                        if digit > 0:
+                            acc = _jacobian_add(acc, odd_multiples[digit >> 1], p, a)
+                        else:
+                            acc = _jacobian_add(acc, _jacobian_negate(odd_multiples[-digit >> 1], p), p, a)
+            result = _jacobian_add(result, acc, p, a)
+
+        return _from_jacobian(result, curve)
+
+# above this many variable-base terms multi_mul switches from interleaved wNAF to pippenger
+_PIPPENGER_THRESHOLD = 64
+
+def _pippenger(terms, p, a):
+    '''
+    Pippenger's bucket method over (jacobian point, non-negative scalar) pairs.
+    Each c-bit window drops every point into the bucket of its digit, then the buckets are
+    summed with a running sum so bucket j is counted j times.
+    '''
+    c = max(2, len(terms).bit_length() - 2)
+    bits = max(scalar.bit_length() for _, scalar in terms)
+    mask = (1 << c) - 1
+
+    result = _JACOBIAN_IDENTITY
+    for start in reversed(range(0, bits, c)):
+        for _ in range(c):
+            result = _jacobian_double(result, p, a)
+
+        buckets = [None] * mask
+        for point, scalar in terms:
+            digit = (scalar >> start) & mask
+            if digit:
+                bucket = buckets[digit - 1]
+                buckets[digit - 1] = point if bucket is None else _jacobian_add(bucket, point, p, a)
+
+        running = _JACOBIAN_IDENTITY
+        window_sum = _JACOBIAN_IDENTITY
+        for bucket in reversed(buckets):
+            if bucket is not None:
+                running = _jacobian_add(running, bucket, p, a)
+            window_sum = _jacobian_add(window_sum, running, p, a)
+        result = _jacobian_add(result, window_sum, p, a)
+
+    return result
+
+def _wnaf(scalar, window):
+    '''
+    Width-w non-adjacent form, least significant digit first.
+    Every non-zero digit is odd, |digit| < 2^(w-1), and is followed by at least w-1 zeros.
+    '''
+    digits = []
+    while scalar:
+        digit = 0
+        if scalar & 1:
+            digit = scalar & ((1 << window) - 1)
+            if digit >= 1 << (window - 1):
+                digit -= 1 << window
+            scalar -= digit
+        digits.append(digit)
+        scalar >>= 1
+    return digits
+
+def _odd_multiples(P, window, p, a):
+    # P, 3P, 5P, ... (2^(w-1) - 1)P, indexed by digit >> 1
+    twice = _jacobian_double(P, p, a)
+    multiples = [P]
+    for _ in range((1 << (window - 2)) - 1):
+        multiples.append(_jacobian_add(multiples[-1], twice, p, a))
+    return multiples
+
+def lift_x(x, curve, odd=False):
+    '''
+    The curve point with the given x coordinate and y parity, or None if x is not on the curve.
+    Square roots use y = rhs^((p+1)/4), which needs p = 3 mod 4 (true for secp256k1).
+    '''
+    if curve.p % 4 != 3:
+        raise ValueError("lift_x needs a curve prime with p = 3 mod 4.")
+    if not 0 <= x < curve.p:
+        return None
+
+    rhs = (x**3 + curve.a*x + curve.b) % curve.p
+    y = pow(rhs, (curve.p + 1) // 4, curve.p)
+    if y * y % curve.p != rhs:
+        return None
+    if (y & 1) != odd:
+        y = curve.p - y
+    return Point(x, y, curve)
+
+# internal jacobian representation: (X, Y, Z) is the affine point (X/Z^2, Y/Z^3).
+# add and double need no modular inversion, only the final conversion to affine does.
+_JACOBIAN_IDENTITY = (1, 1, 0)
+
+def _to_jacobian(point):
+    if point.x is None:
+        return _JACOBIAN_IDENTITY
+    return (point.x, point.y, 1)
+
+def _from_jacobian(jacobian, curve):
+    X, Y, Z = jacobian
+    if Z == 0:
+        return Point(None, None, curve)
+
+    z_inv = inv(Z, curve.p)
+    z_inv2 = z_inv * z_inv % curve.p
+    return Point(X * z_inv2 % curve.p, Y * z_inv2 * z_inv % curve.p, curve)
+
+class _FixedBaseTable:
+    '''
+    Precomputed windows for a point that is multiplied over and over, like the generator.
+    Row i holds j * 2^(window*i) * base for every window digit j, so a multiply is
+    one (mixed) addition per window and no doublings.
+    '''
+    def __init__(self, base, window):
+        curve = base.curve
+        self.p = curve.p
+        self.a = curve.a
+        self.n = curve.n
+        self.window = window
+        self.mask = (1 << window) - 1
+        self.rows = []
+
+        row_base = _to_jacobian(base)
+        for _ in range((curve.n.bit_length() + window - 1) // window):
+            row = [_JACOBIAN_IDENTITY]
+            for _ in range(self.mask):
+                row.append(_jacobian_add(row[-1], row_base, self.p, self.a))
+            self.rows.append(row)
+
+            for _ in range(window):
+                row_base = _jacobian_double(row_base, self.p, self.a)
+
+        # store affine entries (Z == 1) so every addition in multiply is a cheap mixed addition.
+        # normalized all at once, a single inversion for the whole table
+        size = self.mask + 1
+        flat = _normalize_many([entry for row in self.rows for entry in row], self.p)
+        self.rows = [flat[i:i + size] for i in range(0, len(flat), size)]
+
+    def multiply(self, scalar):
+        scalar %= self.n # the base has order n, so this does not change the result
+        result = _JACOBIAN_IDENTITY
+        for row in self.rows:
+            digit = scalar & self.mask
+            if digit:
+                result = _jacobian_add(result, row[digit], self.p, self.a)
+            scalar >>= self.window
+        return result
+
+# fixed bases are registered up front, their tables are built on first use
+_fixed_base_tables = {}
+
+def register_fixed_base(point, window=8):
+    '''
+    Cache a window table for a point of order curve.n that will be multiplied many times.
+    '''
+    _fixed_base_tables[(point.curve.p, point.x, point.y)] = window
+
+def _fixed_base_table(point):
+    key = (point.curve.p, point.x, point.y)
+    table = _fixed_base_tables.get(key)
+    if table is None or isinstance(table, _FixedBaseTable):
+        return table
+
+    table = _FixedBaseTable(point, window=table)
+    _fixed_base_tables[key] = table
+    return table
+
+def _normalize_many(points, p):
+    # jacobian points to affine (Z == 1), sharing one inversion across all of them (Montgomery's trick)
+    z_invs = inv_many([Z for _, _, Z in points], p)
+    normalized = []
+    for (X, Y, Z), z_inv in zip(points, z_invs):
+        if Z == 0 or Z == 1:
+            normalized.append((X, Y, Z))
+            continue
+        z_inv2 = z_inv * z_inv % p
+        normalized.append((X * z_inv2 % p, Y * z_inv2 * z_inv % p, 1))
+    return normalized
+
+def _jacobian_negate(P, p):
+    X, Y, Z = P
+    return (X, -Y % p, Z)
+
+def _jacobian_double(P, p, a):
+    X, Y, Z = P
+    if Z == 0 or Y == 0:
+        return _JACOBIAN_IDENTITY
+
+    Y2 = Y * Y % p
+    S = 4 * X * Y2 % p
+    M = 3 * X * X
+    if a:
+        M += a * pow(Z, 4, p)
+    M %= p
+
+    X3 = (M * M - 2 * S) % p
+    Y3 = (M * (S - X3) - 8 * Y2 * Y2) % p
+    Z3 = 2 * Y * Z % p
+    return (X3, Y3, Z3)
+
+def _jacobian_add(P, Q, p, a):
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    if Z1 == 0:
+        return Q
+    if Z2 == 0:
+        return P
+
+    Z1Z1 = Z1 * Z1 % p
+    U2 = X2 * Z1Z1 % p
+    S2 = Y2 * Z1 * Z1Z1 % p
+    if Z2 == 1: # mixed addition, Q is affine
+        U1, S1 = X1, Y1
+    else:
+        Z2Z2 = Z2 * Z2 % p
+        U1 = X1 * Z2Z2 % p
+        S1 = Y1 * Z2 * Z2Z2 % p
+
+    H = (U2 - U1) % p
+    R = (S2 - S1) % p
+    if H == 0:
+        if R == 0: # same point, use the tangent
+            return _jacobian_double(P, p, a)
+        return _JACOBIAN_IDENTITY # vertical line
+
+    H2 = H * H % p
+    H3 = H * H2 % p
+    U1H2 = U1 * H2 % p
+
+    X3 = (R * R - H3 - 2 * U1H2) % p
+    Y3 = (R * (U1H2 - X3) - S1 * H3) % p
+    Z3 = H * Z1 * Z2 % p
+    return (X3, Y3, Z3)
 
 bitcoin_curve = Curve(
     p = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F,
@@ -96,6 +392,7 @@ bitcoin_G = Point(
     y = 0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8,
     curve = bitcoin_curve
 )
+register_fixed_base(bitcoin_G)
 
 if __name__ == '__main__':
     print(f'bitcoin generator is on curve: {bitcoin_G.is_on_curve()}')
@@ -103,4 +400,24 @@ if __name__ == '__main__':
     print(f'double method test passed: {bitcoin_G.double() == (bitcoin_G + bitcoin_G)}')
     print(f'double-and-add method test passed: {(bitcoin_G*5) == (bitcoin_G + bitcoin_G + bitcoin_G + bitcoin_G + bitcoin_G)}')
     print(f'secp256k1 group order test passed: {(bitcoin_G * bitcoin_curve.n).x is None}') # G * n is identity
+    print(f'fixed-base table test passed: {(bitcoin_G * 1000003) == (Point(bitcoin_G.x, bitcoin_G.y, bitcoin_curve).double() * 500001 + bitcoin_G)}')
+    print(f'multi-scalar multiplication test passed: {Point.multi_mul([(bitcoin_G, 12345), (bitcoin_G * 7, 67890), (bitcoin_G * 3, -5)]) == bitcoin_G * (12345 + 7*67890 - 15)}')
+    print(f'pippenger multi-scalar multiplication test passed: {Point.multi_mul([(bitcoin_G * (i + 2), i) for i in range(100)]) == bitcoin_G * sum((i + 2) * i for i in range(100))}')
+    print(f'lift_x test passed: {lift_x(bitcoin_G.x, bitcoin_curve, odd=bool(bitcoin_G.y & 1)) == bitcoin_G}')
+    print(f'jacobian multiplication test passed: {(bitcoin_G * 1000003) == (bitcoin_G * 1000002 + bitcoin_G) and (bitcoin_G * 1000003).is_on_curve()}')
+    print(f'batch key generation test passed: {bitcoin_G.mul_many([5, 0, 1000003]) == [bitcoin_G * 5, Point(None, None, bitcoin_curve), bitcoin_G * 1000003]}')
+
+    import random
+    import time
+    private_keys = [random.randrange(1, bitcoin_curve.n) for _ in range(1000)]
+    start_time = time.time()
+    one_by_one = [bitcoin_G * sk for sk in private_keys]
+    single_time = time.time() - start_time
+    start_time = time.time()
+    batched = bitcoin_G.mul_many(private_keys)
+    batch_time = time.time() - start_time
+    print(f'{len(private_keys)} public keys: {round(single_time*1000)}ms one at a time, {round(batch_time*1000)}ms with mul_many. same keys: {one_by_one == batched}')
 
+    start_time = time.time()
+    _FixedBaseTable(bitcoin_G, window=8)
+    print(f'generator table built in {round((time.time() - start_time)*1000)}ms')
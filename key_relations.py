@@ -29,11 +29,15 @@ def privateToPublicKey(private_key, compressed=True):
 
     private_key_int = int.from_bytes(private_key_bytes, byteorder='big')
     public_key_point = bitcoin_G * private_key_int
-    
+
+    return pointToPublicKey(public_key_point, compressed=compressed)
+
+def pointToPublicKey(public_key_point, compressed=True):
     x_coord = public_key_point.x.to_bytes(32, byteorder='big').hex().upper()
     y_coord = public_key_point.y.to_bytes(32, byteorder='big').hex().upper()
     if compressed:
-        public_key = '02' + x_coord # compressed address uses x coord only
+        # compressed key uses x coord only, the prefix tells which of the two possible y it has
+        public_key = ('03' if public_key_point.y & 1 else '02') + x_coord
     else:
         public_key = '04' + x_coord + y_coord
 
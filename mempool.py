@@ -0,0 +1,140 @@
+import heapq
+import itertools
+
+class Mempool:
+    '''
+    Valid transactions waiting to be mined, ordered by fee.
+
+    Two heaps index the same transactions: a max-heap on fee to pick block templates and a
+    min-heap on fee to evict when the pool is full. Removal only drops the transaction from
+    self.transactions; heap entries that no longer match it are skipped when they surface and
+    the heaps are rebuilt once stale entries outnumber live ones.
+    '''
+    def __init__(self, max_size=10000):
+        self.max_size = max_size # None for an unbounded pool
+        self.transactions = {} # tx_id -> (transaction, sequence)
+
+        self._highest_fee = [] # (-fee, sequence, tx_id), ties go to the oldest transaction
+        self._lowest_fee = [] # (fee, -sequence, tx_id), ties evict the newest transaction
+        self._sequence = itertools.count()
+
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, transaction):
+        return transaction.tx_id in self.transactions
+
+    def __iter__(self):
+        return (transaction for transaction, _ in self.transactions.values())
+
+    def add(self, transaction):
+        '''
+        Add a transaction. Returns False if it is already pooled, or if the pool is full and its
+        fee does not beat the cheapest pooled transaction.
+        '''
+        if transaction.tx_id in self.transactions:
+            return False
+
+        if self.max_size is not None and len(self.transactions) >= self.max_size:
+            self._discard_stale(self._lowest_fee)
+            if not self._lowest_fee or transaction.tx_fee <= self._lowest_fee[0][0]:
+                return False # nothing to evict when max_size is 0
+            _, _, tx_id = heapq.heappop(self._lowest_fee)
+            del self.transactions[tx_id]
+            self.evicted += 1
+
+        sequence = next(self._sequence)
+        self.transactions[transaction.tx_id] = (transaction, sequence)
+        heapq.heappush(self._highest_fee, (-transaction.tx_fee, sequence, transaction.tx_id))
+        heapq.heappush(self._lowest_fee, (transaction.tx_fee, -sequence, transaction.tx_id))
+        return True
+
+    def remove(self, tx_id):
+        # returns the removed transaction, or None if it was not pooled
+        entry = self.transactions.pop(tx_id, None)
+        if entry is None:
+            return None
+
+        # top() keeps stale entries off the max-heap, so the min-heap is usually the one that grows
+        if max(len(self._highest_fee), len(self._lowest_fee)) > 2*len(self.transactions) + 32:
+            self._rebuild()
+        return entry[0]
+
+    def remove_confirmed(self, transactions):
+        # drop the transactions of a block that was just added to the chain
+        for transaction in transactions:
+            self.remove(transaction.tx_id)
+
+    def top(self, k):
+        '''
+        The k highest fee transactions, highest first, in O(k log n) without sorting the pool.
+        '''
+        selected = []
+        popped = []
+        while self._highest_fee and len(selected) < k:
+            entry = heapq.heappop(self._highest_fee)
+            if self._is_live(entry[2], entry[1]):
+                selected.append(self.transactions[entry[2]][0])
+                popped.append(entry)
+
+        for entry in popped:
+            heapq.heappush(self._highest_fee, entry)
+        return selected
+
+    def _is_live(self, tx_id, sequence):
+        entry = self.transactions.get(tx_id)
+        return entry is not None and entry[1] == sequence
+
+    def _discard_stale(self, heap):
+        # pop removed transactions off the top of the min-heap
+        while heap and not self._is_live(heap[0][2], -heap[0][1]):
+            heapq.heappop(heap)
+
+    def _rebuild(self):
+        self._highest_fee = [(-tx.tx_fee, sequence, tx_id) for tx_id, (tx, sequence) in self.transactions.items()]
+        self._lowest_fee = [(tx.tx_fee, -sequence, tx_id) for tx_id, (tx, sequence) in self.transactions.items()]
+        heapq.heapify(self._highest_fee)
+        heapq.heapify(self._lowest_fee)
+
+if __name__ == '__main__':
+    from transaction import Transaction
+    from elliptic_curve import bitcoin_G
+    import time
+
+    receiver = bitcoin_G * 987654321
+    senders = [bitcoin_G * sk for sk in range(1, 21)]
+    def make_tx(i, fee):
+        return Transaction(sender_pk=senders[i % len(senders)], receiver_pk=receiver, amount=i, fee=fee)
+
+    mempool = Mempool(max_size=5)
+    txs = [make_tx(i, fee) for i, fee in enumerate([5, 1, 9, 3, 7])]
+    for tx in txs:
+        mempool.add(tx)
+    print(f'top test passed: {[tx.tx_fee for tx in mempool.top(3)] == [9, 7, 5]}')
+
+    rejected = not mempool.add(make_tx(5, 1))
+    accepted = mempool.add(make_tx(6, 4))
+    print(f'eviction test passed: {rejected and accepted and txs[1] not in mempool and mempool.evicted == 1 and len(mempool) == 5}')
+
+    print(f'empty pool test passed: {not Mempool(max_size=0).add(make_tx(7, 100))}')
+
+    removed = mempool.remove(txs[2].tx_id)
+    print(f'remove test passed: {removed == txs[2] and txs[2] not in mempool and [tx.tx_fee for tx in mempool.top(2)] == [7, 5]}')
+
+    # a standing backlog under a flood of new transactions: mine the best ones, keep adding more
+    mempool = Mempool(max_size=None)
+    backlog = 5000
+    i = 0
+    for _ in range(backlog):
+        mempool.add(make_tx(i, i % 97))
+        i += 1
+    start_time = time.time()
+    for _ in range(20000):
+        mempool.add(make_tx(i, i % 97))
+        i += 1
+        mempool.remove_confirmed(mempool.top(1))
+    elapsed = time.time() - start_time
+    heap_size = max(len(mempool._highest_fee), len(mempool._lowest_fee))
+    print(f'bounded heaps test passed: {heap_size <= 2*len(mempool) + 32} ({heap_size} heap entries for {len(mempool)} transactions, {round(elapsed / 20000 * 1e6)}us per add + mine)')
@@ -1,12 +1,76 @@
-import requests
-from pprint import pprint
-import json
 from hash_functions import sha256
+import hashlib
+
+# tx ids and merkle roots are shown as hex in the byte-swapped order block explorers use.
+# internally every hash is kept as 32 raw bytes in the order they are hashed in.
+
+HASH_SIZE = 32
 
 def byte_swap(hex_string):
     # reverse endian-ness of hex string
     return "".join(reversed([hex_string[i:i+2] for i in range(0, len(hex_string), 2)]))
 
+def hash256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def to_internal(hex_hash):
+    return bytes.fromhex(hex_hash)[::-1]
+
+def to_display(internal_hash):
+    return internal_hash[::-1].hex()
+
+def parent_level(level):
+    # hash each pair of a level of concatenated hashes, pairing an odd last hash with itself
+    if len(level) // HASH_SIZE % 2 == 1:
+        level += level[-HASH_SIZE:]
+    view = memoryview(level)
+    return b''.join([hash256(view[i:i + 2*HASH_SIZE]) for i in range(0, len(level), 2*HASH_SIZE)])
+
+class MerkleTree:
+    '''
+    Merkle tree over hex tx ids. Each level is one contiguous bytes buffer of 32-byte hashes,
+    from the leaves (levels[0]) up to the root. proof(index) gives the sibling hashes that,
+    with verify_proof, show a tx id is in the tree knowing only the root.
+    '''
+    def __init__(self, tx_ids):
+        self.levels = [b''.join([to_internal(tx_id) for tx_id in tx_ids])]
+        while len(self.levels[-1]) > HASH_SIZE:
+            self.levels.append(parent_level(self.levels[-1]))
+
+    def __len__(self):
+        return len(self.levels[0]) // HASH_SIZE
+
+    def root(self):
+        return self.levels[-1] if len(self) else None
+
+    def get_root(self):
+        return to_display(self.root()) if len(self) else None
+
+    def proof(self, index):
+        # sibling hashes from the leaf up to just below the root
+        if not 0 <= index < len(self):
+            raise IndexError("merkle leaf index out of range")
+
+        siblings = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling * HASH_SIZE >= len(level):
+                sibling = index # odd last hash is paired with itself
+            siblings.append(level[sibling*HASH_SIZE:(sibling + 1)*HASH_SIZE])
+            index //= 2
+        return siblings
+
+def verify_proof(tx_id, index, proof, root):
+    # True if proof shows tx_id is leaf number index of the tree with this (hex) root
+    current = to_internal(tx_id)
+    for sibling in proof:
+        current = hash256(sibling + current if index % 2 else current + sibling)
+        index //= 2
+    return index == 0 and to_display(current) == root
+
+def merkle_root(tx_ids):
+    return MerkleTree(tx_ids).get_root()
+
 class MerkleNode:
     def __init__(self, children=[], hash256=None):
         self.children = children
@@ -33,7 +97,8 @@ class MerkleNode:
         else:
             self.hash256 = hash256
 
-class MerkleTree:
+class LegacyMerkleTree:
+    # the original node-per-hash tree, kept as the reference MerkleTree is checked and benchmarked against
     def __init__(self, leaves):
         self.leaves = leaves
 
@@ -55,23 +120,54 @@ class MerkleTree:
                     parent_layer.append(MerkleNode(children=children))
                     children = []
 
-            
+
             self.nodes += parent_layer
             layer = parent_layer
-    
+
     def get_root(self):
         return self.nodes[-1].hash256
-    
+
 if __name__ == '__main__':
+    import random
+    import time
+
+    for size in [1, 2, 3, 7, 100, 1001]:
+        tx_ids = [random.randbytes(32).hex() for _ in range(size)]
+        legacy = LegacyMerkleTree(leaves=[MerkleNode(hash256=tx_id) for tx_id in tx_ids])
+        legacy.assemble()
+        tree = MerkleTree(tx_ids)
+        proofs_valid = all(verify_proof(tx_id, index, tree.proof(index), tree.get_root()) for index, tx_id in enumerate(tx_ids))
+        print(f'{size} leaves. root matches legacy: {tree.get_root() == legacy.get_root()}, proofs verify: {proofs_valid}')
+
+    tx_ids = [random.randbytes(32).hex() for _ in range(4000)]
+    tree = MerkleTree(tx_ids)
+    proof = tree.proof(1234)
+    print(f'leaves not mutated: {len(tx_ids) == 4000 and len(tree) == 4000}')
+    print(f'wrong index rejected: {not verify_proof(tx_ids[1234], 1235, proof, tree.get_root())}')
+    print(f'wrong tx rejected: {not verify_proof(tx_ids[1235], 1234, proof, tree.get_root())}')
+
+    for size in [1000, 4000, 16000]:
+        tx_ids = [random.randbytes(32).hex() for _ in range(size)]
+
+        start_time = time.time()
+        legacy = LegacyMerkleTree(leaves=[MerkleNode(hash256=tx_id) for tx_id in tx_ids])
+        legacy.assemble()
+        legacy_time = time.time() - start_time
+
+        start_time = time.time()
+        root = merkle_root(tx_ids)
+        new_time = time.time() - start_time
+
+        print(f'{size} transactions. legacy: {round(legacy_time*1000, 2)}ms, bytes: {round(new_time*1000, 2)}ms ({round(legacy_time/new_time, 1)}x faster)')
+
+    import requests
+
     # test using a real block and merkle root from blockchain.info
     url = 'https://blockchain.info/rawblock/0000000000000000000117b51c3d21681ddae3cc9e81cd9985cff86296e9c238'
     response = requests.get(url)
     block_data = response.json()
 
-    merkle_leaves = [MerkleNode(hash256 = tx['hash']) for tx in block_data['tx']]
-    
-    tree = MerkleTree(leaves=merkle_leaves)
-    tree.assemble()
+    tree = MerkleTree([tx['hash'] for tx in block_data['tx']])
 
     print(f'calculated root: {tree.get_root()}')
     print(f"root from blockchain.info: {block_data['mrkl_root']}")
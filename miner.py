@@ -1,13 +1,20 @@
-from network import start_server, broadcast
-import pickle
-from transaction import Transaction
+from network import broadcast
+from node_runtime import NodeRuntime
+from transaction import signature_cache
 from blockchain import Block, Blockchain
 import threading
 from elliptic_curve import bitcoin_G
+from mining import MiningEngine, MiningController
+from mempool import Mempool
 from consensus_parameters import MINING_DIFFICULTY, BLOCK_SIZE, BLOCK_REWARD
+from block_store import BlockStore
+from validation import BlockValidator
+from block_tree import BlockTree, INVALID, REORG
+from state import load_state
+import os
 import argparse
 import random
-import time
+import atexit
 
 # Miner node:
 # 1. listens for transactions from users, completed blocks from other miners/nodes, and updates to longest chain from miners/nodes
@@ -20,6 +27,12 @@ import time
 parser = argparse.ArgumentParser(description='Run a mining node.')
 parser.add_argument('--home_port', type=int, default=5001, help='Home port for this node.')
 parser.add_argument('--private_key', type=int, default=42, help='Private key of the wallet that earns mining rewards.')
+parser.add_argument('--workers', type=int, default=None, help='Number of mining processes. Defaults to one per core.')
+parser.add_argument('--preempt_interval', type=float, default=0.05, help='Seconds between checks for a new block template while mining.')
+parser.add_argument('--mempool_size', type=int, default=10000, help='Maximum number of transactions in the mempool, lowest fees are evicted first.')
+parser.add_argument('--validation_workers', type=int, default=None, help='Processes that verify block signatures. Defaults to one per core.')
+parser.add_argument('--enforce_balances', action='store_true', help='Reject blocks whose transactions spend more than their senders have.')
+parser.add_argument('--data_dir', type=str, default=None, help='Directory to keep the blockchain in across restarts. In memory only if not set.')
 args = parser.parse_args()
 
 home_port = args.home_port # port the node will
@@ -33,33 +46,29 @@ connections = random.sample(list(all_ports), 1)
 print(f'broadcasting to peers {connections}')
 
 payout_pk = bitcoin_G*args.private_key
-
-block_to_mine = Block()
-new_block_available = threading.Event()
-
-def mine_block():
-    global best_block_to_mine
-    while True:
-        if new_block_available.is_set():
-            new_block_available.clear()
-            best_block_to_mine1 = best_block_to_mine # make a copy that cannot be updated by threading
-
-            if len(best_block_to_mine1.transactions):
-                print(f'mining block with {len(best_block_to_mine1.transactions)} transactions. fee value: {sum([tx.tx_fee for tx in best_block_to_mine1.transactions])}')
-
-                block_solved = best_block_to_mine1.mine(difficulty=MINING_DIFFICULTY, 
-                                                        block_reward=BLOCK_REWARD, 
-                                                        block_reward_receiver=payout_pk, 
-                                                        iterations=int(2e6), # number of hash iterations before checking for a better block to mine
-                                                        )
-                
-                if block_solved:
-                    print('block solved.')
-                    broadcast((best_block_to_mine1, home_port), [home_port] + connections) # ensure you broadcast to your own port to update main_chain & mempool
-                    best_block_to_mine = Block()
-                    best_block_to_mine1 = Block()
-                else:
-                    print('getting new block.')
+mining_engine = MiningEngine(workers=args.workers, poll_interval=args.preempt_interval)
+atexit.register(mining_engine.close)
+
+def mine_template(block, iterations, cancel_event):
+    # one round of the mining controller. a better block template sets cancel_event and stops all workers
+    if block.difficulty is None: # first round on this template
+        print(f'mining block with {len(block.transactions)} transactions. fee value: {sum([tx.tx_fee for tx in block.transactions])}')
+    solved = block.mine(difficulty=MINING_DIFFICULTY, 
+                        block_reward=BLOCK_REWARD, 
+                        block_reward_receiver=payout_pk, 
+                        iterations=iterations,
+                        engine=mining_engine,
+                        cancel_event=cancel_event)
+    stats = mining_controller.stats()
+    print(f'hashrate: {round(mining_engine.hashrate)} hashes/second across {mining_engine.workers} workers. '
+          f'stale work: {round(100*stats["stale_fraction"], 2)}% of hashes, average preemption latency {round(stats["average_preemption_latency"]*1000)}ms')
+    return solved
+
+def block_solved(block):
+    print('block solved.')
+    broadcast((block, home_port), [home_port]) # our own runtime updates main_chain & mempool and relays it to peers
+
+mining_controller = MiningController(mining_engine, mine=mine_template, on_solved=block_solved)
 
 def assemble_best_block(mempool, blockchain):
     # grab the highest fee transactions within the block size limit
@@ -67,89 +76,107 @@ def assemble_best_block(mempool, blockchain):
                                 block_height=blockchain.blocks[-1].block_height+1, # increment block height
                                 transactions=[])
 
-    sorted_txs = sorted(mempool, key=lambda tx: tx.tx_fee, reverse=True)
-
-    for i, tx in enumerate(sorted_txs):
-        if i >= blockchain.block_size:
-            break
+    transactions = mempool.top(blockchain.block_size)
+    if args.enforce_balances:
+        transactions = balances.affordable(transactions)
+    for tx in transactions:
         best_block_to_mine.transactions.append(tx)
 
     return best_block_to_mine    
 
-def manage_mempool():
-    global best_block_to_mine
+store = None
+if args.data_dir is not None:
+    store = BlockStore(args.data_dir)
+    atexit.register(store.close)
+    print(f'loaded {len(store)} blocks from {args.data_dir}')
+
+main_chain = Blockchain(block_size=BLOCK_SIZE, store=store) # empty unless restored from data_dir
+mempool = Mempool(max_size=args.mempool_size)
+validator = BlockValidator(difficulty=MINING_DIFFICULTY, block_size=BLOCK_SIZE, workers=args.validation_workers)
+
+
+# balances at the main chain tip, snapshotted next to the block store so restarts don't replay the chain
+snapshot_path = os.path.join(args.data_dir, 'state.dat') if args.data_dir is not None else None
+balances = load_state(main_chain, snapshot_path)
+if snapshot_path is not None:
+    atexit.register(balances.snapshot, snapshot_path)
+
+def apply_to_state(block):
+    balances.apply_block(block)
+    if snapshot_path is not None and block.block_height % 100 == 0:
+        balances.snapshot(snapshot_path)
+
+def connect_block(block):
+    apply_to_state(block)
+    mempool.remove_confirmed(block.transactions)
+
+def disconnect_block(block):
+    # transactions of a block disconnected by a reorg can be mined again
+    balances.undo_block(block)
+    for tx in block.transactions:
+        if tx.sender_pk is not None:
+            mempool.add(tx)
+
+# keeps main_chain on the branch with the most work, and the balances and mempool in step with it.
+# with --enforce_balances every block's spends are checked as it joins the main chain, reorgs included,
+# and transactions the main chain already has can't be replayed.
+# reorgs can't go deeper than the balance undo records
+block_tree = BlockTree(main_chain, on_connect=connect_block, on_disconnect=disconnect_block,
+                       can_connect=(lambda block: balances.check_block(block, main_chain)) if args.enforce_balances else None,
+                       max_reorg_depth=balances.max_undo)
+
+def update_block_template():
+    # hand the mining thread the best block on the current tip, blocks without transactions aren't mined
+    if len(main_chain.blocks):
+        best_block_to_mine = assemble_best_block(mempool=mempool, blockchain=main_chain)
+        mining_controller.publish(best_block_to_mine if best_block_to_mine.transactions else None)
+
+def handle_block(new_block, address):
+    # structure, proof of work and signatures. whether it extends the main chain, and can be afforded, is decided below
+    reason = validator.validate_block(new_block)
+    if reason is not None:
+        print(f'received invalid block: {reason}. ignoring.')
+        return False
+    print(f'signature cache hit rate: {round(100*signature_cache.hit_rate())}% ({signature_cache.hits} verifications skipped)')
+
+    status = block_tree.add(new_block)
+    if status == INVALID:
+        print(f'received invalid block: {block_tree.last_rejection}. ignoring.')
+        return False
+    if status == REORG:
+        print(f'reorganized {block_tree.last_reorg_depth} blocks onto a branch with more work')
+
+    update_block_template()
+    return True
+
+def handle_transaction(new_transaction, address):
+    if new_transaction.sender_pk is None:
+        print('received unsigned transaction, only blocks can pay rewards. ignoring.')
+        return False
+
+    if not new_transaction.verify_signature():
+        print('received invalid transaction. ignoring.')
+        return False
     
-    server_socket = start_server(home_port)
-
-    main_chain = Blockchain(block_size=BLOCK_SIZE) # start with an empty blockchain
-    mempool = set()
-    seen_messages_buffer = []
-    while True:
-        client_socket, _ = server_socket.accept()
-
-        data = client_socket.recv(1000000)
-        data = pickle.loads(data)
-        address = data[1]
-        data = data[0]
-
-        if address >= 5000 and address <= 5010 and (address not in connections):
-            print(f'added connection {address}')
-            connections.append(address)
-            # when a new connection appears, send them the main_chain one block at a time
-            for block in main_chain.blocks:
-                broadcast((block, home_port), [address])
-                time.sleep(2)
-
-        if data in seen_messages_buffer:
-            continue
-        seen_messages_buffer = (seen_messages_buffer[-19:] + [data]) if len(seen_messages_buffer) >= 20 else (seen_messages_buffer + [data])
-
-        broadcast((data, home_port), connections)
-
-        if isinstance(data, Block):
-            print(f'received block from: {address}\n')
-            new_block = data
-            if not (new_block.verify_proof_of_work(difficulty=MINING_DIFFICULTY) and new_block.verify_tx_signatures()):
-                print('received invalid block. ignoring.')
-                continue
-
-            if len(main_chain.blocks) == 0:
-                # if this is the genesis block
-                main_chain.blocks.append(new_block)
-                for tx in new_block.transactions:
-                    mempool.discard(tx)
-
-            elif new_block.prev_block_hash == main_chain.blocks[-1].block_hash:
-                # if the new block extends the main chain, add it
-                main_chain.blocks.append(new_block)
-                for tx in new_block.transactions:
-                    mempool.discard(tx)
-
-            else:
-                # TODO: node may be out of consensus, look for a longer chain
-                pass
-
-        if isinstance(data, Transaction):
-            print(f'received transaction from: {address}\n')
-            new_transaction = data
-            if not new_transaction.verify_signature():
-                print('received invalid transaction. ignoring.')
-                continue
-            
-            if main_chain.transaction_in_chain(new_transaction):
-                print('received transaction already in chain. ignoring.')
-                continue
-
-            mempool.add(new_transaction)
-            print(f'transactions in mempool: {len(mempool)}')
-
-        if len(main_chain.blocks):
-            best_block_to_mine = assemble_best_block(mempool=mempool, blockchain=main_chain)
-            new_block_available.set() # alert the mining process to switch to new block
-        print(f'blocks in main chain: {len(main_chain.blocks)}')
+    if main_chain.transaction_in_chain(new_transaction):
+        print('received transaction already in chain. ignoring.')
+        return False
+
+    if not mempool.add(new_transaction):
+        print('transaction already in mempool, or mempool is full and its fee is too low. ignoring.')
+        return False
+    print(f'transactions in mempool: {len(mempool)}')
+
+    update_block_template()
+    return True
         
-mining_thread = threading.Thread(target=mine_block)
+update_block_template() # resume mining on top of a restored chain
+mining_thread = threading.Thread(target=mining_controller.run, daemon=True)
 mining_thread.start()
 
-mempool_thread = threading.Thread(target=manage_mempool)
-mempool_thread.start()
\ No newline at end of file
+runtime = NodeRuntime(home_port=home_port,
+                      connections=connections,
+                      blockchain=main_chain,
+                      on_transaction=handle_transaction,
+                      on_block=handle_block)
+runtime.run()
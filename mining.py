@@ -0,0 +1,284 @@
+import hashlib
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+
+# how many hashes a worker computes between checks of its stop event
+CHECK_EVERY = 10000
+
+NONCE = struct.Struct('<Q') # the nonce is the last 8 bytes of the block header
+
+def difficulty_target(difficulty):
+    '''
+    Largest digest (as 32 big-endian bytes) whose hex form starts with `difficulty` zeros.
+    Bytes of equal length compare like the integers they encode, so digest <= target is the pow check.
+    '''
+    return ((1 << (256 - 4*difficulty)) - 1).to_bytes(32, byteorder='big')
+
+def search_nonces(header_prefix, difficulty, start, stop, stop_event=None):
+    '''
+    Try every nonce in [start, stop). Returns (nonce, block_hash, hashes) where nonce and
+    block_hash are None if no valid proof of work was found (or the search was stopped).
+    header_prefix is the serialized block header without its nonce. It is hashed once, each
+    attempt copies that sha256 midstate and only hashes the nonce, so the result is exactly
+    sha256(header_prefix + nonce).
+    '''
+    target = difficulty_target(difficulty)
+    midstate = hashlib.sha256(header_prefix)
+    pack_nonce = NONCE.pack
+    hashes = 0
+
+    for chunk_start in range(start, stop, CHECK_EVERY):
+        if stop_event is not None and stop_event.is_set():
+            break
+
+        for nonce in range(chunk_start, min(chunk_start + CHECK_EVERY, stop)):
+            hasher = midstate.copy()
+            hasher.update(pack_nonce(nonce))
+            digest = hasher.digest()
+            if digest <= target: # if pow found
+                return nonce, digest.hex(), hashes + nonce - chunk_start + 1
+
+        hashes += min(CHECK_EVERY, stop - chunk_start)
+
+    return None, None, hashes
+
+def _worker(jobs, stop_event, results):
+    # long-lived worker process. runs (job id, header_prefix, difficulty, start, stop) searches until it gets None
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, header_prefix, difficulty, start, stop = job
+        results.put((job_id,) + search_nonces(header_prefix, difficulty, start, stop, stop_event))
+
+class MiningEngine:
+    '''
+    Splits the nonce space of a block across a pool of worker processes, so mining is not
+    held to one core by the GIL. The workers are started on the first search and kept for
+    the following ones, each search hands them a nonce range over a queue. Stops all workers
+    as soon as one finds a solution or the caller's cancel event is set, and keeps the
+    aggregate hashrate of the last search.
+    '''
+    def __init__(self, workers=None, poll_interval=0.1):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.poll_interval = poll_interval # seconds between checks of the cancel event
+
+        # fork, not spawn: spawn would re-run the top level of node scripts like miner.py in every worker
+        self.context = multiprocessing.get_context('fork')
+        self.processes = [] # started on first use
+        self.jobs = None
+        self.results = None
+        self.stop_event = None # shared by every search, cleared at the start of each
+        self.job_id = 0
+
+        self.hashes = 0
+        self.elapsed = 0
+
+    @property
+    def hashrate(self):
+        # hashes per second over the last search
+        return self.hashes / self.elapsed if self.elapsed else 0
+
+    def _start_workers(self):
+        self.jobs = self.context.Queue()
+        self.results = self.context.Queue()
+        self.stop_event = self.context.Event()
+        self.processes = [self.context.Process(target=_worker, args=(self.jobs, self.stop_event, self.results), daemon=True)
+                          for _ in range(self.workers)]
+        for process in self.processes:
+            process.start()
+
+    def search(self, header_prefix, difficulty, start, iterations, cancel_event=None):
+        '''
+        Search nonces [start, start + iterations) for a valid proof of work.
+        Returns (nonce, block_hash), or None if nothing was found or the search was cancelled.
+        '''
+        if not self.processes:
+            self._start_workers()
+
+        start_time = time.time()
+        self.job_id += 1
+        self.stop_event.clear() # every worker finished the previous search before it returned
+
+        chunk = -(-iterations // self.workers) # ceiling division
+        for i in range(self.workers):
+            worker_start = start + i*chunk
+            worker_stop = min(worker_start + chunk, start + iterations)
+            self.jobs.put((self.job_id, header_prefix, difficulty, worker_start, worker_stop))
+
+        solution = None
+        hashes = 0
+        finished = 0
+        while finished < self.workers:
+            try:
+                job_id, nonce, block_hash, worker_hashes = self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if cancel_event is not None and cancel_event.is_set():
+                    self.stop_event.set()
+                if not all(process.is_alive() for process in self.processes):
+                    # a worker died and its share of the range will never report back. start over with new workers
+                    self.close()
+                    break
+                continue
+
+            if job_id != self.job_id:
+                continue # left over from a search abandoned because a worker died
+            finished += 1
+            hashes += worker_hashes
+            if nonce is not None and solution is None:
+                solution = (nonce, block_hash)
+                self.stop_event.set() # tell every other worker to stop
+
+        self.hashes = hashes
+        self.elapsed = time.time() - start_time
+
+        return solution
+
+    def close(self):
+        # stop the worker processes, the next search starts new ones
+        for process in self.processes:
+            if process.is_alive():
+                self.jobs.put(None)
+        if self.stop_event is not None:
+            self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+class MiningController:
+    '''
+    Drives a MiningEngine from the miner's mining thread. Sleeps on a condition while there is
+    no block template, mines the current template in rounds of `iterations` hashes until it is
+    solved or replaced, and stops the workers as soon as publish() replaces it (within the
+    engine's poll_interval). mine(template, iterations, cancel_event) runs one round and returns
+    True if the template was solved, on_solved(template) is called for each solved block.
+
+    Stale work is the hashing done on a template after it was replaced, until the workers
+    stopped. It is estimated from the preemption latency and the hashrate of the round.
+    '''
+    def __init__(self, engine, mine, on_solved, iterations=int(2e6)):
+        self.engine = engine
+        self.mine = mine
+        self.on_solved = on_solved
+        self.iterations = iterations
+
+        self.condition = threading.Condition()
+        self.preempted = threading.Event() # cancel event of the round in progress
+        self.template = None
+        self.generation = 0 # number of templates published
+        self.published_at = None
+
+        self.hashes = 0
+        self.rounds = 0
+        self.solved = 0
+        self.preemptions = 0
+        self.stale_hashes = 0
+        self.stale_seconds = 0 # total preemption latency
+        self.idle_seconds = 0
+
+    def publish(self, template):
+        # replace the block being mined. None stops mining until the next template
+        with self.condition:
+            self.template = template
+            self.generation += 1
+            self.published_at = time.time()
+            self.preempted.set()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                idle_since = time.time()
+                while self.template is None:
+                    self.condition.wait()
+                self.idle_seconds += time.time() - idle_since
+                template, generation = self.template, self.generation
+                self.preempted.clear()
+
+            solved = self.mine(template, self.iterations, self.preempted)
+            self.rounds += 1
+            self.hashes += self.engine.hashes
+
+            if solved:
+                self.solved += 1
+                with self.condition:
+                    if self.generation == generation:
+                        self.template = None # wait for a template that builds on the solved block
+                self.on_solved(template)
+
+            elif self.preempted.is_set():
+                with self.condition:
+                    latency = time.time() - self.published_at
+                self.preemptions += 1
+                self.stale_seconds += latency
+                self.stale_hashes += min(self.engine.hashes, int(self.engine.hashrate * latency))
+
+    def stats(self):
+        return {
+            'hashes': self.hashes,
+            'rounds': self.rounds,
+            'solved': self.solved,
+            'preemptions': self.preemptions,
+            'stale_hashes': self.stale_hashes,
+            'stale_fraction': self.stale_hashes / self.hashes if self.hashes else 0,
+            'average_preemption_latency': self.stale_seconds / self.preemptions if self.preemptions else 0,
+            'idle_seconds': self.idle_seconds,
+        }
+
+if __name__ == '__main__':
+    # compare against hashing the whole block string for every attempt, as Block.mine used to
+    from hash_functions import sha256
+    import random
+
+    block_data = ''.join(str(random.getrandbits(256)) for _ in range(40)) # roughly a 10 transaction block
+    header_prefix = random.getrandbits(80*8).to_bytes(80, byteorder='big') # a block header without its nonce
+    iterations = 200000
+
+    start_time = time.time()
+    for nonce in range(iterations):
+        sha256((block_data + str(random.randint(1, 2**256))).encode('utf-8'), return_hex=True).startswith('0'*6)
+    string_rate = iterations / (time.time() - start_time)
+
+    start_time = time.time()
+    search_nonces(header_prefix, 64, 0, iterations)
+    midstate_rate = iterations / (time.time() - start_time)
+
+    print(f'string hashing: {round(string_rate)} hashes/second')
+    print(f'header midstate hashing: {round(midstate_rate)} hashes/second ({round(midstate_rate / string_rate, 1)}x)')
+
+    nonce, block_hash, _ = search_nonces(header_prefix, 3, 0, iterations)
+    print(f'midstate hash matches full hash: {block_hash == sha256(header_prefix + NONCE.pack(nonce), return_hex=True) and block_hash.startswith("000")}')
+
+    # preemption: replace the template mid-search and measure how long the workers kept going
+    engine = MiningEngine(workers=2, poll_interval=0.02)
+    controller = MiningController(engine,
+                                  mine=lambda template, iterations, cancel_event: engine.search(template, 64, 0, iterations, cancel_event) is not None,
+                                  on_solved=lambda template: None,
+                                  iterations=int(1e8))
+    threading.Thread(target=controller.run, daemon=True).start()
+    time.sleep(0.2)
+    idle = controller.rounds == 0
+    for _ in range(3):
+        controller.publish(random.getrandbits(80*8).to_bytes(80, byteorder='big'))
+        time.sleep(0.5)
+    controller.publish(None)
+    time.sleep(0.5)
+
+    stats = controller.stats()
+    print(f'idle without a template: {idle}')
+    print(f'workers reused across {stats["rounds"]} rounds: {len(engine.processes) == 2}')
+    print(f'preempted {stats["preemptions"]} times, average latency {round(stats["average_preemption_latency"]*1000)}ms, stale hashes {round(100*stats["stale_fraction"], 2)}%')
+
+    # many short rounds, the cost the long-lived workers save
+    engine.close()
+    rounds = 20
+    start_time = time.time()
+    for _ in range(rounds):
+        engine.search(header_prefix, 64, 0, 10000)
+    print(f'{rounds} rounds of 10000 hashes on {engine.workers} workers: {round((time.time() - start_time) / rounds * 1000, 1)}ms per round')
+    engine.close()
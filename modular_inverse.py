@@ -14,7 +14,7 @@
 #     output "greatest common divisor:", old_r
 #     output "quotients by the gcd:", (t, s)
 
-def inv(x, p):
+def inv_euclid(x, p):
     """
     calculates (gcd, x, y) s.t. ax + by == gcd mod p
     taken from Wikipedia.
@@ -34,7 +34,56 @@ def inv(x, p):
 
     return old_s % p
 
+def inv(x, p):
+    # python's built in modular inverse (3.8+) runs the same algorithm in C
+    try:
+        return pow(x, -1, p)
+    except ValueError:
+        return inv_euclid(x, p) # x has no inverse mod p, keep the euclid loop's result (0 for x == 0)
+
+def inv_many(values, p):
+    """
+    Montgomery's trick: invert every value with a single inversion and 3(N-1) multiplications.
+    prefix[i] is the product of values[:i+1], inverting the full product and walking back
+    peels the inverse of one value off at a time. values that are 0 mod p get inv's result.
+    """
+    values = [x % p for x in values]
+    prefix = []
+    product = 1
+    for x in values:
+        if x:
+            product = product * x % p
+        prefix.append(product)
+
+    try:
+        product_inv = pow(product, -1, p)
+    except ValueError:
+        return [inv(x, p) for x in values] # p isn't prime and some value shares a factor with it
+
+    inverses = [0] * len(values)
+    for i in reversed(range(len(values))):
+        x = values[i]
+        if not x:
+            inverses[i] = inv(x, p)
+            continue
+        inverses[i] = product_inv * (prefix[i - 1] if i else 1) % p
+        product_inv = product_inv * x % p
+    return inverses
+
 if __name__ == "__main__":
     print(f'inverse of 5 mod 3: {inv(5,3)}')
     print(f'inverse of 2 mod 11: {inv(2,11)}')
-    print(f'inverse of 12 mod 97: {inv(12,97)}')
\ No newline at end of file
+    print(f'inverse of 12 mod 97: {inv(12,97)}')
+    print(f'batch inverse test passed: {inv_many([12, 0, 5, 96], 97) == [inv(12, 97), 0, inv(5, 97), inv(96, 97)]}')
+
+    import random
+    import time
+    p = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F # secp256k1 field prime
+    values = [random.randrange(1, p) for _ in range(10000)]
+    for name, invert in [('euclid loop', lambda: [inv_euclid(x, p) for x in values]),
+                         ('pow', lambda: [inv(x, p) for x in values]),
+                         ('inv_many', lambda: inv_many(values, p))]:
+        start_time = time.time()
+        inverses = invert()
+        elapsed = time.time() - start_time
+        print(f'{name}: {round(elapsed / len(values) * 1e6, 2)}us per inverse. correct: {all(x * y % p == 1 for x, y in zip(values, inverses))}')
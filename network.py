@@ -1,23 +1,99 @@
+from codec import encode_message
 import socket
-import pickle
+import queue
+import struct
+import threading
+import time
+
+# every message on a connection is a 4 byte big-endian length followed by that many payload bytes
+LENGTH_PREFIX = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 32*1024*1024
+
+INITIAL_BACKOFF = 0.5 # seconds before the first reconnect attempt
+MAX_BACKOFF = 30
 
 def start_server(port):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind(('127.0.0.1', port))
-    server_socket.listen(5)
+    server_socket.listen(64)
 
     return server_socket
 
+def send_message(sock, payload):
+    sock.sendall(LENGTH_PREFIX.pack(len(payload)) + payload)
+
+class Peer:
+    '''
+    Long-lived outbound connection to one peer. Messages go through a bounded send queue
+    drained by the peer's own thread, so a slow or unreachable peer never blocks gossip to
+    the others. Failed sends reconnect with exponential backoff and retry the message.
+    '''
+    def __init__(self, port, queue_size=1000):
+        self.port = port
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.socket = None
+        self.backoff = INITIAL_BACKOFF
+        self.dropped = 0 # messages discarded because the send queue was full
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            self.dropped += 1
+
+    def pending(self):
+        return self.queue.unfinished_tasks
+
+    def _connect(self):
+        self.socket = socket.create_connection(('127.0.0.1', self.port), timeout=10)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def _run(self):
+        while True:
+            payload = self.queue.get()
+            while True:
+                try:
+                    if self.socket is None:
+                        self._connect()
+                    send_message(self.socket, payload)
+                    self.backoff = INITIAL_BACKOFF
+                    break
+                except OSError:
+                    self._close()
+                    time.sleep(self.backoff)
+                    self.backoff = min(self.backoff*2, MAX_BACKOFF)
+            self.queue.task_done()
+
+_peers = {}
+_peers_lock = threading.Lock()
+
+def get_peer(port):
+    with _peers_lock:
+        if port not in _peers:
+            _peers[port] = Peer(port)
+        return _peers[port]
+
 def broadcast(message, ports):
-    serialized_message = pickle.dumps(message)
+    serialized_message = encode_message(*message) # (message, sender port)
     for port in ports:
-        try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect(('127.0.0.1', port))
-            client_socket.send(serialized_message)
-            client_socket.close()
-        except ConnectionRefusedError:
-            continue
-        except TimeoutError:
-            print(f"Connection timed out on port {port}")
-            continue
\ No newline at end of file
+        get_peer(port).send(serialized_message)
+
+def flush(timeout=10):
+    # wait until every queued message is sent, for short lived scripts that broadcast and exit
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with _peers_lock:
+            peers = list(_peers.values())
+        if not any(peer.pending() for peer in peers):
+            return True
+        time.sleep(0.05)
+    return False
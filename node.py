@@ -1,11 +1,16 @@
-from blockchain import Block, Blockchain
-from transaction import Transaction
-import pickle
-from network import start_server, broadcast
+from blockchain import Blockchain
+from transaction import signature_cache
+from node_runtime import NodeRuntime, LightRuntime
 from consensus_parameters import MINING_DIFFICULTY, BLOCK_SIZE
+from block_store import BlockStore
+from validation import BlockValidator
+from block_tree import BlockTree, INVALID, REORG
+from state import load_state
+import os
 import random
 import argparse
-import time
+import atexit
+import sys
 
 # non-mining node:
 # 1. listens for newly mined blocks and updates to the longest chain
@@ -15,6 +20,12 @@ import time
 
 parser = argparse.ArgumentParser(description='Run a mining node.')
 parser.add_argument('--home_port', type=int, default=5001, help='Home port for this node.')
+parser.add_argument('--validation_workers', type=int, default=None, help='Processes that verify block signatures. Defaults to one per core.')
+parser.add_argument('--enforce_balances', action='store_true', help='Reject blocks whose transactions spend more than their senders have.')
+parser.add_argument('--data_dir', type=str, default=None, help='Directory to keep the blockchain in across restarts. In memory only if not set.')
+parser.add_argument('--light', action='store_true', help='Run as a light (SPV) node that keeps only block headers.')
+parser.add_argument('--watch', type=str, nargs='*', default=[], help='tx_ids a light node waits on merkle proofs for.')
+parser.add_argument('--api_port', type=int, default=None, help='Index transactions by address and serve GET /history/<address or public key> on this local port.')
 args = parser.parse_args()
 
 home_port = args.home_port # port the node will
@@ -27,68 +38,99 @@ all_ports.discard(home_port)
 connections = random.sample(list(all_ports), 1)
 print(f'broadcasting to peers {connections}')
 
-server_socket = start_server(home_port)
-main_chain = Blockchain(block_size=BLOCK_SIZE)
-seen_messages_buffer = []
-while True:
-    client_socket, _ = server_socket.accept()
-
-    data = client_socket.recv(1000000)
-    data = pickle.loads(data)
-    address = data[1]
-    data = data[0]
-
-    if address >= 5000 and address <= 5010 and (address not in connections):
-        print(f'added connection {address}')
-        connections.append(address)
-        # when a new connection appears, send them the main_chain one block at a time
-        for block in main_chain.blocks:
-            broadcast((block, home_port), [address])
-            time.sleep(2)
-
-    if data in seen_messages_buffer:
-        continue
-    seen_messages_buffer = (seen_messages_buffer[-19:] + [data]) if len(seen_messages_buffer) >= 20 else (seen_messages_buffer + [data])
-
-    broadcast((data, home_port), connections)
-
-    if isinstance(data, Transaction):
-        print(f'received transaction from: {address}\n')
-        new_transaction = data
-        
-        if not new_transaction.verify_signature():
-            print('received invalid transaction. ignoring.')
-            continue
-        
-        if main_chain.transaction_in_chain(new_transaction):
-            print('received transaction already in chain. ignoring.')
-            continue
-
-
-    if isinstance(data, Block):
-        print(f'received block from: {address}\n')
-        new_block = data
-        print(f'received new block with {len(new_block.transactions)-1} transactions.') # -1 to account for block reward
-        print(main_chain.__dict__)
-
-        valid_pow = new_block.verify_proof_of_work(difficulty=MINING_DIFFICULTY)
-        valid_signatures = new_block.verify_tx_signatures()
-
-        if not (valid_pow and valid_signatures):
-            print('received invalid block. ignoring.')
-            continue
-
-        if len(main_chain.blocks) == 0:
-            main_chain.blocks.append(new_block)
-            
-
-        elif new_block.prev_block_hash == main_chain.blocks[-1].block_hash:
-            # if the new block extends the main chain, add it
-            main_chain.blocks.append(new_block)
-            # broadcast((main_chain, home_port), connections)
-        else:
-            # TODO: node is out of consensus, resolve
-            print('received block that doesnt fit on main chain')
-            pass
-        
-    print(f'blocks in main chain: {len(main_chain.blocks)}')
\ No newline at end of file
+if args.light:
+    # headers and merkle proofs only, no blocks or transactions are validated or stored
+    print(f'running as a light node watching {len(args.watch)} transactions')
+    LightRuntime(home_port=home_port, connections=connections, watched=args.watch).run()
+    sys.exit()
+
+store = None
+if args.data_dir is not None:
+    store = BlockStore(args.data_dir)
+    atexit.register(store.close)
+    print(f'loaded {len(store)} blocks from {args.data_dir}')
+
+main_chain = Blockchain(block_size=BLOCK_SIZE, store=store)
+validator = BlockValidator(difficulty=MINING_DIFFICULTY, block_size=BLOCK_SIZE, workers=args.validation_workers)
+
+# balances at the main chain tip, snapshotted next to the block store so restarts don't replay the chain
+snapshot_path = os.path.join(args.data_dir, 'state.dat') if args.data_dir is not None else None
+balances = load_state(main_chain, snapshot_path)
+if snapshot_path is not None:
+    atexit.register(balances.snapshot, snapshot_path)
+
+# optional transaction history by address, rebuilt from the chain at startup
+address_index = None
+if args.api_port is not None:
+    from address_index import AddressIndex, serve_history # needs base58, only required with --api_port
+    address_index = AddressIndex()
+    address_index.catch_up(main_chain)
+    serve_history(address_index, main_chain, args.api_port)
+    print(f'serving transaction history for {len(address_index)} public keys on port {args.api_port}')
+
+def connect_block(block):
+    balances.apply_block(block)
+    if snapshot_path is not None and block.block_height % 100 == 0:
+        balances.snapshot(snapshot_path)
+    if address_index is not None:
+        address_index.connect_block(block)
+
+def disconnect_block(block):
+    balances.undo_block(block)
+    if address_index is not None:
+        address_index.disconnect_block(block)
+
+# keeps main_chain, the balances and the address index on the branch with the most work.
+# with --enforce_balances every block's spends are checked as it joins the main chain, reorgs included,
+# and transactions the main chain already has can't be replayed.
+# reorgs can't go deeper than the balance undo records
+block_tree = BlockTree(main_chain, on_connect=connect_block, on_disconnect=disconnect_block,
+                       can_connect=(lambda block: balances.check_block(block, main_chain)) if args.enforce_balances else None,
+                       max_reorg_depth=balances.max_undo)
+
+def handle_transaction(new_transaction, address):
+    if new_transaction.sender_pk is None:
+        print('received unsigned transaction, only blocks can pay rewards. ignoring.')
+        return False
+
+    if not new_transaction.verify_signature():
+        print('received invalid transaction. ignoring.')
+        return False
+    
+    if main_chain.transaction_in_chain(new_transaction):
+        print('received transaction already in chain. ignoring.')
+        return False
+
+    return True
+
+def handle_block(new_block, address):
+    print(f'received new block with {len(new_block.transactions)-1} transactions.') # -1 to account for block reward
+    print(main_chain.__dict__)
+
+    # structure, proof of work and signatures. whether it extends the main chain, and can be afforded, is decided below
+    reason = validator.validate_block(new_block)
+    if reason is not None:
+        print(f'received invalid block: {reason}. ignoring.')
+        return False
+    print(f'signature cache hit rate: {round(100*signature_cache.hit_rate())}% ({signature_cache.hits} verifications skipped)')
+
+    if address_index is not None:
+        with address_index.lock: # history queries wait until the chain and the index agree again
+            status = block_tree.add(new_block)
+    else:
+        status = block_tree.add(new_block)
+    if status == INVALID:
+        print(f'received invalid block: {block_tree.last_rejection}. ignoring.')
+        return False
+    print(f'block {status}. main chain height: {main_chain.blocks[-1].block_height if len(main_chain.blocks) else None}')
+    if status == REORG:
+        print(f'reorganized {block_tree.last_reorg_depth} blocks')
+
+    return True
+
+runtime = NodeRuntime(home_port=home_port,
+                      connections=connections,
+                      blockchain=main_chain,
+                      on_transaction=handle_transaction,
+                      on_block=handle_block)
+runtime.run()
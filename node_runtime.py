@@ -0,0 +1,336 @@
+from network import LENGTH_PREFIX, MAX_MESSAGE_SIZE, start_server, broadcast
+from codec import decode_message
+from blockchain import Block
+from transaction import Transaction
+from relay import TX, BLOCK, Inventory, GetData, CompactBlock, GetBlockTransactions, BlockTransactions
+from sync import MAX_HEADERS, ChainSync, GetHeaders, Headers, headers_after
+from spv import GetMerkleProof, MerkleProof, HeaderChain, merkle_proof
+from caches import SeenCache
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import asyncio
+
+def remember(mapping, key, value, limit):
+    # insert into an OrderedDict, dropping the oldest entries past limit
+    mapping[key] = value
+    mapping.move_to_end(key)
+    while len(mapping) > limit:
+        mapping.popitem(last=False)
+
+class NodeRuntime:
+    '''
+    asyncio server shared by node.py and miner.py.
+
+    Every peer connection is read as a stream of length-prefixed messages by its own coroutine,
+    so any number of peers can be connected at once. Messages go through a bounded queue to a
+    single dispatcher. When the queue is full the readers stop reading, which pushes back on
+    the senders through TCP instead of dropping connections. The dispatcher does the shared
+    gossip work and hands each new transaction or block to the node's handler in an executor,
+    keeping the event loop free for I/O.
+
+    Gossip is inventory based: accepted transactions are announced by tx_id and peers ask
+    (GetData) only for what they don't have. With compact_blocks, accepted blocks are pushed
+    as a CompactBlock that peers rebuild from their recent transactions, fetching only the
+    missing ones. Otherwise blocks are announced by hash like transactions.
+
+    Catching up is pull based (sync.ChainSync): on start, and whenever a peer appears or
+    relays a block beyond our tip, we ask for headers and then download the bodies.
+    '''
+    def __init__(self, home_port, connections, blockchain, on_transaction, on_block, queue_size=1000,
+                 compact_blocks=True, known_transactions_limit=50000, recent_blocks_limit=100,
+                 pending_compact_blocks_limit=16, seen_cache_size=100000, seen_cache_max_age=None):
+        self.home_port = home_port
+        self.connections = connections # ports we relay to, grows as new peers reach us
+        self.blockchain = blockchain
+        self.on_transaction = on_transaction # handler(message, address) -> True if accepted, run in the executor
+        self.on_block = on_block
+        self.queue_size = queue_size
+        self.compact_blocks = compact_blocks
+
+        # one thread so handlers see messages one at a time, in arrival order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.seen_messages = SeenCache(max_size=seen_cache_size, max_age=seen_cache_max_age) # by tx_id / block hash
+
+        # recently seen objects, used to answer GetData and to rebuild compact blocks
+        self.known_transactions = OrderedDict() # tx_id -> transaction
+        self.known_transactions_limit = known_transactions_limit
+        self.recent_blocks = OrderedDict() # block_hash -> block
+        self.recent_blocks_limit = recent_blocks_limit
+        self.pending_compact_blocks = OrderedDict() # block_hash -> CompactBlock waiting for missing transactions
+        self.pending_compact_blocks_limit = pending_compact_blocks_limit
+
+        self.sync = ChainSync(blockchain, self.send)
+
+        self.message_handlers = {
+            Transaction: self.handle_transaction,
+            Block: self.handle_block,
+            Inventory: self.handle_inventory,
+            GetData: self.handle_get_data,
+            CompactBlock: self.handle_compact_block,
+            GetBlockTransactions: self.handle_get_block_transactions,
+            BlockTransactions: self.handle_block_transactions,
+            GetHeaders: self.handle_get_headers,
+            Headers: self.handle_headers,
+            GetMerkleProof: self.handle_get_merkle_proof,
+        }
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.messages = asyncio.Queue(maxsize=self.queue_size)
+        server = await asyncio.start_server(self.read_connection, sock=start_server(self.home_port))
+        async with server:
+            self.request_headers(self.connections)
+            asyncio.create_task(self.check_sync_timeouts())
+            await self.dispatch()
+
+    async def check_sync_timeouts(self):
+        while True:
+            await asyncio.sleep(1)
+            self.sync.check_timeouts()
+
+    async def read_connection(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(LENGTH_PREFIX.size)
+                (size,) = LENGTH_PREFIX.unpack(header)
+                if size > MAX_MESSAGE_SIZE:
+                    break
+                payload = await reader.readexactly(size)
+                await self.messages.put(decode_message(payload)) # waits while the queue is full
+        except Exception: # closed connection or malformed message, drop the peer
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self):
+        while True:
+            data, address = await self.messages.get()
+
+            if address >= 5000 and address <= 5010 and (address not in self.connections):
+                print(f'added connection {address}')
+                self.connections.append(address)
+                self.request_headers([address]) # the new peer may know a longer chain
+
+            try:
+                await self.message_handlers[type(data)](data, address)
+            except Exception as error: # a malformed message must not stop the node
+                print(f'dropped {type(data).__name__} from {address}: {error!r}')
+
+    def request_headers(self, peers):
+        self.sync.request_headers(peers)
+
+    def send(self, message, ports):
+        broadcast((message, self.home_port), ports)
+
+    def announce(self, message, exclude):
+        self.send(message, [port for port in self.connections if port != exclude])
+
+    def find_block(self, block_hash):
+        block = self.recent_blocks.get(block_hash)
+        return block if block is not None else self.blockchain.get_block_by_hash(block_hash)
+
+    async def handle_transaction(self, transaction, address):
+        if self.seen_messages.check_and_add(transaction.tx_id):
+            return
+
+        print(f'received transaction from: {address}\n')
+        accepted = await asyncio.get_running_loop().run_in_executor(self.executor, self.on_transaction, transaction, address)
+        if accepted:
+            # only valid transactions are served to peers and used to rebuild compact blocks
+            remember(self.known_transactions, transaction.tx_id, transaction, self.known_transactions_limit)
+            self.announce(Inventory(TX, [transaction.tx_id]), exclude=address)
+        print(f'blocks in main chain: {len(self.blockchain.blocks)}')
+
+    async def handle_block(self, block, address):
+        if block.block_hash is not None and self.sync.expects(block.block_hash):
+            await self.connect_synced_block(block, address)
+            return
+
+        if block.block_hash is not None and block.header().hash() != block.block_hash:
+            # the hash is sent as is, a body that doesn't match it must not be cached or served under it
+            print(f'block from {address} does not match its hash. ignoring.')
+            return
+        seen_key = block.block_hash or block.merkle_root()
+        if self.seen_messages.check(seen_key):
+            return
+
+        print(f'received block from: {address}\n')
+        if block.block_height is not None and block.block_height > self.sync.tail()[1] + 1:
+            self.request_headers([address]) # we are missing the blocks before it
+
+        accepted = await asyncio.get_running_loop().run_in_executor(self.executor, self.on_block, block, address)
+        if accepted:
+            # marked seen only once accepted, so an invalid body can't shadow the real block
+            self.seen_messages.add(seen_key)
+            if block.block_hash is not None:
+                remember(self.recent_blocks, block.block_hash, block, self.recent_blocks_limit)
+            if self.compact_blocks:
+                self.announce(CompactBlock.from_block(block), exclude=address)
+            else:
+                self.announce(Inventory(BLOCK, [block.block_hash]), exclude=address)
+        print(f'blocks in main chain: {len(self.blockchain.blocks)}. duplicate messages suppressed: {self.seen_messages.hits} ({round(100*self.seen_messages.hit_rate())}%)')
+
+    async def handle_inventory(self, inventory, address):
+        if inventory.kind == TX:
+            missing = [tx_id for tx_id in inventory.hashes if tx_id not in self.known_transactions]
+        else:
+            missing = [block_hash for block_hash in inventory.hashes
+                       if self.find_block(block_hash) is None and block_hash not in self.pending_compact_blocks]
+
+        if missing:
+            self.send(GetData(inventory.kind, missing), [address])
+
+    async def handle_get_data(self, request, address):
+        for requested_hash in request.hashes:
+            if request.kind == TX:
+                found = self.known_transactions.get(requested_hash)
+            else:
+                found = self.find_block(requested_hash)
+            if found is not None:
+                self.send(found, [address])
+
+    async def handle_compact_block(self, compact_block, address):
+        block_hash = compact_block.block_hash
+        if self.find_block(block_hash) is not None or block_hash in self.pending_compact_blocks:
+            return
+        if not compact_block.verify_header(self.sync.difficulty):
+            # checked before fill(), which hashes every known transaction
+            print(f'compact block from {address} has an invalid header or proof of work. ignoring.')
+            return
+
+        missing = compact_block.fill(self.known_transactions)
+        if missing:
+            print(f'compact block is missing {len(missing)} of {len(compact_block.transactions)} transactions. requesting them.')
+            remember(self.pending_compact_blocks, block_hash, compact_block, self.pending_compact_blocks_limit)
+            self.send(GetBlockTransactions(block_hash, missing), [address])
+            return
+
+        await self.finish_compact_block(compact_block, address)
+
+    async def handle_get_block_transactions(self, request, address):
+        block = self.find_block(request.block_hash)
+        if block is None:
+            return
+        transactions = [block.transactions[index] for index in request.indexes if 0 <= index < len(block.transactions)]
+        self.send(BlockTransactions(request.block_hash, transactions), [address])
+
+    async def handle_block_transactions(self, response, address):
+        compact_block = self.pending_compact_blocks.pop(response.block_hash, None)
+        if compact_block is None:
+            return
+
+        if compact_block.add_missing(response.transactions):
+            self.send(GetData(BLOCK, [response.block_hash]), [address]) # still incomplete, fall back to the full block
+            return
+        await self.finish_compact_block(compact_block, address)
+
+    async def finish_compact_block(self, compact_block, address):
+        block = compact_block.to_block()
+        if block.header().hash() != block.block_hash:
+            # a short id matched the wrong transaction, the merkle root gives it away. fall back to the full block
+            self.send(GetData(BLOCK, [block.block_hash]), [address])
+            return
+        await self.handle_block(block, address)
+
+    async def connect_synced_block(self, block, address):
+        ready = self.sync.on_block(block, address)
+        for index, (ready_block, peer) in enumerate(ready):
+            try:
+                accepted = await asyncio.get_running_loop().run_in_executor(self.executor, self.on_block, ready_block, peer)
+            except Exception as error: # transient, e.g. a storage error. fetch it again
+                print(f'could not connect synced block {ready_block.block_height}: {error!r}')
+                self.sync.retry(ready[index:])
+                break
+            if not accepted:
+                print(f'synced block {ready_block.block_height} from {peer} is invalid. dropping it and the headers built on it.')
+                self.sync.reject(ready[index:])
+                break
+        if ready:
+            print(f'synced to height {self.sync.tail()[1]}. blocks in main chain: {len(self.blockchain.blocks)}')
+
+    async def handle_get_headers(self, request, address):
+        self.send(Headers(headers_after(self.blockchain, request.locator, request.count)), [address])
+
+    async def handle_headers(self, message, address):
+        self.sync.on_headers(message.headers, address)
+
+    async def handle_get_merkle_proof(self, request, address):
+        for tx_id in request.tx_ids:
+            proof = merkle_proof(self.blockchain, tx_id)
+            if proof is not None:
+                self.send(proof, [address])
+
+class LightRuntime(NodeRuntime):
+    '''
+    Runtime for light (SPV) nodes. Keeps only the header chain, synced from peers the same way
+    full nodes sync theirs, and asks peers for merkle proofs of the watched transactions until
+    each is confirmed. Block announcements only trigger a header request, transactions are
+    ignored and nothing is relayed, but the header chain is served to peers that ask for it.
+    '''
+    def __init__(self, home_port, connections, watched, on_confirmed=None, header_chain=None, queue_size=1000):
+        super().__init__(home_port, connections, blockchain=None, on_transaction=None, on_block=None, queue_size=queue_size)
+        self.header_chain = header_chain if header_chain is not None else HeaderChain()
+        self.watched = set(watched) # tx_ids
+        self.confirmed = {} # tx_id -> block_hash
+        self.on_confirmed = on_confirmed # handler(tx_id, block height)
+
+        self.message_handlers = {
+            Transaction: self.ignore,
+            Inventory: self.handle_inventory,
+            Block: self.handle_block_announcement,
+            CompactBlock: self.handle_block_announcement,
+            GetHeaders: self.handle_get_headers,
+            Headers: self.handle_headers,
+            MerkleProof: self.handle_merkle_proof,
+        }
+
+    def request_headers(self, peers):
+        for peer in peers:
+            self.send(GetHeaders(self.header_chain.locator()), [peer])
+
+    def request_proofs(self, peers):
+        unconfirmed = [tx_id for tx_id in self.watched if tx_id not in self.confirmed]
+        if unconfirmed:
+            self.send(GetMerkleProof(unconfirmed), peers)
+
+    async def ignore(self, message, address):
+        pass
+
+    async def handle_inventory(self, inventory, address):
+        if inventory.kind == BLOCK and any(block_hash not in self.header_chain.index for block_hash in inventory.hashes):
+            self.request_headers([address])
+
+    async def handle_block_announcement(self, block, address):
+        if block.block_hash not in self.header_chain.index:
+            self.request_headers([address])
+
+    async def handle_get_headers(self, request, address):
+        self.send(Headers(self.header_chain.headers_after(request.locator, request.count)), [address])
+
+    async def handle_headers(self, message, address):
+        reorgs = self.header_chain.reorgs
+        added = self.header_chain.extend(message.headers)
+        if self.header_chain.reorgs != reorgs:
+            # confirmations in blocks that left the main chain have to be proven again
+            self.confirmed = {tx_id: block_hash for tx_id, block_hash in self.confirmed.items() if block_hash in self.header_chain.index}
+        if len(message.headers) == MAX_HEADERS and added:
+            self.request_headers([address])
+        if added:
+            print(f'headers synced to height {self.header_chain.tail()[1]}')
+            self.request_proofs([address])
+
+    async def handle_merkle_proof(self, proof, address):
+        if proof.tx_id not in self.watched or proof.tx_id in self.confirmed:
+            return
+        block_height = self.header_chain.verify(proof)
+        if block_height is None:
+            print(f'invalid merkle proof for {proof.tx_id} from {address}. ignoring.')
+            return
+
+        self.confirmed[proof.tx_id] = proof.block_hash
+        confirmations = self.header_chain.tail()[1] - block_height + 1
+        print(f'transaction {proof.tx_id} confirmed in block {block_height} ({confirmations} confirmations)')
+        if self.on_confirmed is not None:
+            self.on_confirmed(proof.tx_id, block_height)
@@ -0,0 +1,123 @@
+from blockchain import Block, BlockHeader, MAX_DIFFICULTY
+from hash_functions import sha256
+
+# inventory-based gossip: peers announce what they have by hash and only send full objects on request.
+# blocks can instead be relayed as compact blocks: the header plus a short id per transaction,
+# rebuilt from the receiver's own recent transactions with a round trip only for the missing ones.
+
+# inventory kinds
+TX = 1
+BLOCK = 2
+
+SHORT_ID_SIZE = 6
+
+class Inventory:
+    # announcement of transactions or blocks by hash
+    def __init__(self, kind, hashes):
+        self.kind = kind
+        self.hashes = hashes
+
+class GetData:
+    # request for the full transactions or blocks behind announced hashes
+    def __init__(self, kind, hashes):
+        self.kind = kind
+        self.hashes = hashes
+
+class GetBlockTransactions:
+    # request for the transactions at these positions of a compact block that could not be rebuilt locally
+    def __init__(self, block_hash, indexes):
+        self.block_hash = block_hash
+        self.indexes = indexes
+
+class BlockTransactions:
+    def __init__(self, block_hash, transactions):
+        self.block_hash = block_hash
+        self.transactions = transactions
+
+def short_id(block_hash, tx_id):
+    # salted with the block hash so colliding transactions can't be crafted ahead of time
+    return sha256(bytes.fromhex(block_hash) + bytes.fromhex(tx_id))[:SHORT_ID_SIZE]
+
+class CompactBlock:
+    '''
+    A mined block as its header, a short id for each transaction the receiver probably has
+    and the full transactions it can't have (the block reward). The header includes the merkle
+    root, so its hash and proof of work can be checked before any transaction is looked up.
+    '''
+    def __init__(self, version, block_height, prev_block_hash, merkle_root, difficulty, proof_of_work, block_hash, short_ids, prefilled):
+        self.version = version
+        self.block_height = block_height
+        self.prev_block_hash = prev_block_hash
+        self.merkle_root = merkle_root
+        self.difficulty = difficulty
+        self.proof_of_work = proof_of_work
+        self.block_hash = block_hash
+        self.short_ids = short_ids # in block order, skipping the prefilled positions
+        self.prefilled = prefilled # [(index in block, transaction)]
+
+        self.transactions = None # slots filled by fill() / add_missing()
+
+    @classmethod
+    def from_block(cls, block):
+        short_ids = []
+        prefilled = []
+        for index, tx in enumerate(block.transactions):
+            if tx.sender_pk is None:
+                prefilled.append((index, tx))
+            else:
+                short_ids.append(short_id(block.block_hash, tx.tx_id))
+
+        return cls(block.version, block.block_height, block.prev_block_hash, block.merkle_root(), block.difficulty,
+                   block.proof_of_work, block.block_hash, short_ids, prefilled)
+
+    def header(self):
+        return BlockHeader(self.version, self.prev_block_hash, self.merkle_root, self.block_height, self.difficulty, self.proof_of_work)
+
+    def verify_header(self, difficulty):
+        # the header hashes to block_hash with at least the required proof of work
+        if not difficulty <= self.difficulty <= MAX_DIFFICULTY:
+            return False
+        return self.header().hash() == self.block_hash and self.block_hash.startswith('0'*self.difficulty)
+
+    def fill(self, known_transactions):
+        '''
+        Rebuild as much of the block as possible from known transactions (tx_id -> transaction).
+        Returns the indexes of the transactions that still have to be requested.
+        '''
+        self.transactions = [None] * (len(self.short_ids) + len(self.prefilled))
+        for index, tx in self.prefilled:
+            self.transactions[index] = tx
+
+        wanted = set(self.short_ids)
+        candidates = {}
+        for tx_id, tx in list(known_transactions.items()):
+            key = short_id(self.block_hash, tx_id)
+            if key in wanted:
+                # two known transactions with the same short id are ambiguous, request the real one
+                candidates[key] = None if key in candidates else tx
+
+        short_ids = iter(self.short_ids)
+        for index, slot in enumerate(self.transactions):
+            if slot is None:
+                self.transactions[index] = candidates.get(next(short_ids))
+
+        return self.missing()
+
+    def missing(self):
+        return [index for index, tx in enumerate(self.transactions) if tx is None]
+
+    def add_missing(self, transactions):
+        # transactions answering a GetBlockTransactions for self.missing(), in the same order
+        for index, tx in zip(self.missing(), transactions):
+            self.transactions[index] = tx
+        return self.missing()
+
+    def to_block(self):
+        block = Block(block_height=self.block_height,
+                      prev_block_hash=self.prev_block_hash,
+                      transactions=list(self.transactions))
+        block.version = self.version
+        block.difficulty = self.difficulty
+        block.proof_of_work = self.proof_of_work
+        block.block_hash = self.block_hash
+        return block
@@ -1,7 +1,7 @@
 from transaction import Transaction
 from blockchain import Block, Blockchain
 from elliptic_curve import bitcoin_G
-from network import broadcast
+from network import broadcast, flush
 from consensus_parameters import MINING_DIFFICULTY, BLOCK_SIZE
 import time
 import random
@@ -18,4 +18,5 @@ genesis_block = Block(block_height=0,
 genesis_block.mine(difficulty=MINING_DIFFICULTY, block_reward=50, block_reward_receiver=bitcoin_G * 42, iterations=int(1e12))
 
 broadcast((genesis_block, 42), receivers)
+flush()
 print(f'seed chain broadcasted.')
\ No newline at end of file
@@ -0,0 +1,169 @@
+from blockchain import EMPTY_HASH
+from merkle import MerkleTree, verify_proof
+from sync import MAX_HEADERS, locator_positions, header_extends
+from block_tree import block_work
+from consensus_parameters import MINING_DIFFICULTY
+
+# simplified payment verification. a light node keeps only the header chain, checking that it
+# links up and carries valid proof of work, and confirms the transactions it watches with merkle
+# proofs from full nodes instead of downloading blocks.
+
+class GetMerkleProof:
+    def __init__(self, tx_ids):
+        self.tx_ids = tx_ids
+
+class MerkleProof:
+    # tx_id is leaf number index of the merkle tree of block_hash, proof is MerkleTree.proof(index)
+    def __init__(self, tx_id, block_hash, index, proof):
+        self.tx_id = tx_id
+        self.block_hash = block_hash
+        self.index = index
+        self.proof = proof
+
+def merkle_proof(blockchain, tx_id):
+    # a full node's answer to GetMerkleProof, None if the transaction isn't in its main chain
+    location = blockchain.tx_index.get(tx_id)
+    if location is None:
+        return None
+    block_height, index = location
+    block = blockchain.get_block(block_height)
+    tree = MerkleTree([tx.tx_id for tx in block.transactions])
+    return MerkleProof(tx_id, block.block_hash, index, tree.proof(index))
+
+class HeaderChain:
+    '''
+    The main chain as headers only, for light nodes. Headers are accepted if they extend a known
+    header with valid proof of work, by the same check as the full node's headers-first sync, and
+    the main chain is the branch with the most cumulative work, as in BlockTree.
+    '''
+    def __init__(self, difficulty=MINING_DIFFICULTY):
+        self.difficulty = difficulty
+        self.headers = [] # main chain BlockHeader by height
+        self.hashes = []
+        self.index = {} # main chain block_hash -> height
+        self.known = {} # block_hash -> (header, cumulative work), on any branch
+        self.reorgs = 0
+
+    def __len__(self):
+        return len(self.headers)
+
+    def tail(self):
+        if self.headers:
+            return self.hashes[-1], self.headers[-1].block_height
+        return EMPTY_HASH, -1
+
+    def locator(self):
+        return [self.hashes[position] for position in locator_positions(len(self.hashes))]
+
+    def headers_after(self, locator, count):
+        # answer to GetHeaders, like sync.headers_after for a full chain
+        start = 0
+        for block_hash in locator:
+            if block_hash in self.index:
+                start = self.index[block_hash] + 1
+                break
+        return self.headers[start:start + min(count, MAX_HEADERS)]
+
+    def get(self, block_hash):
+        height = self.index.get(block_hash)
+        return None if height is None else self.headers[height]
+
+    def work(self, block_hash):
+        return self.known[block_hash][1] if block_hash in self.known else 0
+
+    def extend(self, headers):
+        # returns how many headers were added, on any branch. stops at the first one that doesn't
+        # extend a known header
+        best_hash = self.tail()[0]
+        added = 0
+        for header in headers:
+            block_hash = header.hash()
+            if block_hash in self.known:
+                continue
+            parent = self.known.get(header.prev_block_hash)
+            parent_height = parent[0].block_height if parent is not None else -1
+            if parent is None and header.prev_block_hash != EMPTY_HASH:
+                break
+            if not header_extends(header, block_hash, header.prev_block_hash, parent_height, self.difficulty):
+                break
+
+            work = self.work(header.prev_block_hash) + block_work(header.difficulty)
+            self.known[block_hash] = (header, work)
+            if work > self.work(best_hash):
+                best_hash = block_hash
+            added += 1
+
+        if best_hash != self.tail()[0]:
+            self._switch_tip(best_hash)
+        return added
+
+    def _switch_tip(self, tip_hash):
+        # walk back from the new tip to the main chain, then replace everything after the fork point
+        branch = []
+        block_hash = tip_hash
+        while block_hash != EMPTY_HASH and block_hash not in self.index:
+            branch.append(block_hash)
+            block_hash = self.known[block_hash][0].prev_block_hash
+        fork_height = self.index[block_hash] if block_hash != EMPTY_HASH else -1
+
+        if fork_height + 1 < len(self.hashes):
+            self.reorgs += 1
+        for stale_hash in self.hashes[fork_height + 1:]:
+            del self.index[stale_hash]
+        del self.headers[fork_height + 1:]
+        del self.hashes[fork_height + 1:]
+
+        for block_hash in reversed(branch):
+            self.index[block_hash] = len(self.headers)
+            self.headers.append(self.known[block_hash][0])
+            self.hashes.append(block_hash)
+
+    def verify(self, merkle_proof):
+        # height of the block the proven transaction is in, None if the proof doesn't check out
+        header = self.get(merkle_proof.block_hash)
+        if header is None:
+            return None
+        if not verify_proof(merkle_proof.tx_id, merkle_proof.index, merkle_proof.proof, header.merkle_root):
+            return None
+        return header.block_height
+
+if __name__ == '__main__':
+    from blockchain import Block, Blockchain
+    from transaction import Transaction
+    from elliptic_curve import bitcoin_G
+
+    chain = Blockchain(block_size=10)
+    prev_block_hash = ''
+    for height in range(5):
+        txs = [Transaction(sender_pk=bitcoin_G * (height + 2), receiver_pk=bitcoin_G * i, amount=i, fee=0) for i in range(1, 8)]
+        for tx in txs:
+            tx.set_signature((height + 1, tx.amount)) # made up signatures, a merkle proof only needs distinct tx ids
+        block = Block(block_height=height, prev_block_hash=prev_block_hash, transactions=txs)
+        block.mine(difficulty=1, block_reward=50, block_reward_receiver=bitcoin_G * 42, iterations=int(1e6))
+        chain.add_block(block)
+        prev_block_hash = block.block_hash
+
+    light = HeaderChain(difficulty=1)
+    added = light.extend([block.header() for block in chain.blocks])
+    print(f'header chain test passed: {added == 5 and light.tail() == (prev_block_hash, 4)}')
+
+    watched = chain.blocks[2].transactions[5]
+    proof = merkle_proof(chain, watched.tx_id)
+    print(f'merkle proof test passed: {light.verify(proof) == 2}')
+
+    proof.index += 1
+    print(f'bad proof rejected: {light.verify(proof) is None}')
+
+    unlinked = chain.blocks[2].header()
+    print(f'unlinked header rejected: {HeaderChain(difficulty=1).extend([chain.blocks[0].header(), unlinked]) == 1}')
+
+    # a heavier branch forking after block 2 takes over, a lighter one is only stored
+    heavier = Block(block_height=3, prev_block_hash=chain.blocks[2].block_hash, transactions=[])
+    heavier.mine(difficulty=2, block_reward=50, block_reward_receiver=bitcoin_G * 43, iterations=int(1e6))
+    print(f'heavier branch test passed: {light.extend([heavier.header()]) == 1 and light.tail() == (heavier.block_hash, 3) and light.reorgs == 1}')
+    stale_proof = merkle_proof(chain, chain.blocks[4].transactions[0].tx_id)
+    print(f'stale header dropped: {chain.blocks[4].block_hash not in light.index and light.verify(stale_proof) is None}')
+
+    block = Block(block_height=5, prev_block_hash=chain.blocks[4].block_hash, transactions=[])
+    block.mine(difficulty=1, block_reward=50, block_reward_receiver=bitcoin_G * 42, iterations=int(1e6))
+    print(f'lighter branch stored: {light.extend([block.header()]) == 1 and light.tail()[0] == heavier.block_hash and len(light.known) == 7}')
@@ -0,0 +1,252 @@
+from codec import Encoder, Decoder
+import math
+import os
+import struct
+
+# account balances by public key, kept in step with the main chain. each connected block is
+# applied in O(transactions in block) and leaves an undo record, so a reorg rolls blocks back
+# without replaying the chain.
+
+SNAPSHOT_MAGIC = b'BFSPSTA1'
+SNAPSHOT_HEADER = struct.Struct('<8s32sQ') # magic, tip block hash, tip height
+
+def account(public_key):
+    return (public_key.x, public_key.y)
+
+class BalanceState:
+    '''
+    Balances after the block at self.tip. Senders pay amount + fee, receivers get amount, and
+    the fees of a block go to its block reward receiver. Undo records (the balances a block
+    overwrote) are kept for the last max_undo blocks, which bounds how deep a reorg can roll
+    the state back.
+    '''
+    def __init__(self, max_undo=100):
+        self.balances = {} # (x, y) -> balance
+        self.undo = [] # [(block_hash, {account: balance before the block, None if it had none})], oldest first
+        self.max_undo = max_undo
+        self.tip = None # hash of the last applied block
+        self.height = -1
+
+    def balance(self, public_key):
+        return self.balances.get(account(public_key), 0)
+
+    @staticmethod
+    def changes(transactions):
+        # account -> net change in balance from these transactions
+        changes = {}
+        fees = 0
+        reward_receiver = None
+        for tx in transactions:
+            if tx.sender_pk is None:
+                reward_receiver = account(tx.receiver_pk)
+            else:
+                sender = account(tx.sender_pk)
+                changes[sender] = changes.get(sender, 0) - tx.amount - tx.tx_fee
+                fees += tx.tx_fee
+            receiver = account(tx.receiver_pk)
+            changes[receiver] = changes.get(receiver, 0) + tx.amount
+
+        if reward_receiver is not None and fees:
+            changes[reward_receiver] = changes.get(reward_receiver, 0) + fees
+        return changes
+
+    def affordable(self, transactions):
+        # the transactions that can be applied in order without any sender going below zero
+        balances = {}
+        selected = []
+        for tx in transactions:
+            # nan compares false with everything, so it would pass the checks below
+            if not (math.isfinite(tx.amount) and math.isfinite(tx.tx_fee)) or tx.amount < 0 or tx.tx_fee < 0:
+                continue
+            if tx.sender_pk is not None:
+                sender = account(tx.sender_pk)
+                balance = balances.get(sender, self.balances.get(sender, 0)) - tx.amount - tx.tx_fee
+                if balance < 0:
+                    continue
+                balances[sender] = balance
+            receiver = account(tx.receiver_pk)
+            balances[receiver] = balances.get(receiver, self.balances.get(receiver, 0)) + tx.amount
+            selected.append(tx)
+        return selected
+
+    def check_block(self, block, blockchain=None):
+        # reason the block's spends are invalid on top of this state, None if they are fine.
+        # with the blockchain the state follows, transactions it already confirmed can't be replayed
+        if block.prev_block_hash != (self.tip or ''):
+            return 'block does not build on the state tip'
+        if blockchain is not None:
+            replayed = next((tx for tx in block.transactions if tx.tx_id in blockchain.tx_index), None)
+            if replayed is not None:
+                return f'transaction {replayed.tx_id} is already in the chain'
+        affordable = self.affordable(block.transactions)
+        if len(affordable) != len(block.transactions):
+            bad = next(tx for tx in block.transactions if tx not in affordable)
+            return f'transaction {bad.tx_id} spends more than its sender has, or a negative or non-finite amount'
+        return None
+
+    def apply_block(self, block):
+        undo = {}
+        for key, change in self.changes(block.transactions).items():
+            undo[key] = self.balances.get(key)
+            self.balances[key] = self.balances.get(key, 0) + change
+
+        self.undo.append((block.block_hash, undo))
+        if len(self.undo) > self.max_undo:
+            self.undo.pop(0)
+        self.tip = block.block_hash
+        self.height = block.block_height
+
+    def undo_block(self, block):
+        # roll back the last applied block
+        if not self.undo or self.undo[-1][0] != block.block_hash:
+            raise ValueError(f"No undo record for block {block.block_hash}, it is not the state tip or too deep to roll back.")
+
+        _, undo = self.undo.pop()
+        for key, balance in undo.items():
+            if balance is None:
+                del self.balances[key]
+            else:
+                self.balances[key] = balance
+        self.tip = block.prev_block_hash or None
+        self.height = block.block_height - 1
+
+    def snapshot(self, path):
+        # write the state to disk, replacing the previous snapshot only once the new one is complete
+        encoder = Encoder()
+        encoder.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, bytes.fromhex(self.tip or '00'*32), self.height + 1))
+
+        encoder.write_varint(len(self.balances))
+        for (x, y), balance in self.balances.items():
+            encoder.write_int256(x)
+            encoder.write_int256(y)
+            encoder.write_number(balance)
+
+        encoder.write_varint(len(self.undo))
+        for block_hash, undo in self.undo:
+            encoder.write_hash(block_hash)
+            encoder.write_varint(len(undo))
+            for (x, y), balance in undo.items():
+                encoder.write_int256(x)
+                encoder.write_int256(y)
+                encoder.write_byte(balance is not None)
+                if balance is not None:
+                    encoder.write_number(balance)
+
+        with open(path + '.tmp', 'wb') as snapshot_file:
+            snapshot_file.write(encoder.buffer)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, max_undo=100):
+        with open(path, 'rb') as snapshot_file:
+            decoder = Decoder(snapshot_file.read())
+
+        magic, tip, count = decoder.read_struct(SNAPSHOT_HEADER)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a state snapshot.")
+
+        state = cls(max_undo=max_undo)
+        state.tip = tip.hex() if count else None
+        state.height = count - 1
+
+        for _ in range(decoder.read_varint()):
+            key = (decoder.read_int256(), decoder.read_int256())
+            state.balances[key] = decoder.read_number()
+
+        for _ in range(decoder.read_varint()):
+            block_hash = decoder.read_hash()
+            undo = {}
+            for _ in range(decoder.read_varint()):
+                key = (decoder.read_int256(), decoder.read_int256())
+                undo[key] = decoder.read_number() if decoder.read_byte() else None
+            state.undo.append((block_hash, undo))
+        return state
+
+    def catch_up(self, blockchain):
+        '''
+        Bring a loaded snapshot up to the blockchain's tip by applying only the blocks after it.
+        Returns False if the snapshot's tip is not on the main chain, in which case the state
+        has to be rebuilt from genesis.
+        '''
+        start = 0
+        if self.tip is not None:
+            if blockchain.block_index.get(self.tip) != self.height:
+                return False
+            start = self.height + 1
+        for height in range(start, len(blockchain.blocks)):
+            self.apply_block(blockchain.blocks[height])
+        return True
+
+def load_state(blockchain, path=None, max_undo=100):
+    # the state at the blockchain's tip, from the snapshot at path if it is usable, else replayed from genesis
+    if path is not None and os.path.exists(path):
+        state = BalanceState.load(path, max_undo=max_undo)
+        if state.catch_up(blockchain):
+            return state
+        print(f'state snapshot {path} is not on the main chain. replaying the chain.')
+    state = BalanceState(max_undo=max_undo)
+    state.catch_up(blockchain)
+    return state
+
+if __name__ == '__main__':
+    from blockchain import Block, Blockchain
+    from transaction import Transaction
+    from elliptic_curve import bitcoin_G
+    import tempfile
+    import time
+
+    alice, bob, miner = bitcoin_G * 5, bitcoin_G * 6, bitcoin_G * 42
+
+    def block_on(prev_block, transactions, reward_receiver=miner):
+        block = Block(block_height=prev_block.block_height + 1 if prev_block else 0,
+                      prev_block_hash=prev_block.block_hash if prev_block else '',
+                      transactions=transactions)
+        block.mine(difficulty=1, block_reward=50, block_reward_receiver=reward_receiver, iterations=int(1e6))
+        return block
+
+    state = BalanceState()
+    genesis = block_on(None, [], reward_receiver=alice)
+    state.apply_block(genesis)
+
+    tx = Transaction(sender_pk=alice, receiver_pk=bob, amount=30, fee=2)
+    tx.sign(sk=5)
+    block = block_on(genesis, [tx])
+    check = state.check_block(block)
+    state.apply_block(block)
+    print(f'apply test passed: {check is None and (state.balance(alice), state.balance(bob), state.balance(miner)) == (18, 30, 52)}')
+
+    overspend = Transaction(sender_pk=bob, receiver_pk=alice, amount=31, fee=0)
+    overspend.sign(sk=6)
+    print(f'overspend rejected: {state.check_block(block_on(block, [overspend])) is not None}')
+
+    not_a_number = Transaction(sender_pk=bob, receiver_pk=alice, amount=float('nan'), fee=0)
+    not_a_number.sign(sk=6)
+    print(f'nan amount rejected: {state.check_block(block_on(block, [not_a_number])) is not None}')
+
+    chain = Blockchain(block_size=10)
+    chain.add_block(genesis)
+    chain.add_block(block)
+    print(f'replay rejected: {"already in the chain" in (state.check_block(block_on(block, [tx]), chain) or "")}')
+
+    path = os.path.join(tempfile.mkdtemp(), 'state.dat')
+    state.snapshot(path)
+    loaded = BalanceState.load(path)
+    print(f'snapshot test passed: {loaded.balances == state.balances and loaded.tip == state.tip and loaded.undo == state.undo}')
+
+    state.undo_block(block)
+    print(f'undo test passed: {(state.balance(alice), state.balance(bob), state.balance(miner)) == (50, 0, 0) and state.tip == genesis.block_hash}')
+
+    # applying a block costs the same no matter how many balances the state holds
+    for accounts in [1000, 100000]:
+        state = BalanceState()
+        state.balances = {(i, i): 100 for i in range(accounts)}
+        state.tip = block.block_hash
+        txs = [Transaction(sender_pk=bitcoin_G * i, receiver_pk=bob, amount=1, fee=0) for i in range(2, 12)]
+        next_block = block_on(block, txs)
+        start_time = time.time()
+        for _ in range(100):
+            state.apply_block(next_block)
+            state.undo_block(next_block)
+        print(f'{accounts} accounts: apply + undo {round((time.time() - start_time) / 100 * 1e6)}us per block')
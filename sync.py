@@ -0,0 +1,226 @@
+from blockchain import EMPTY_HASH, MAX_DIFFICULTY
+from relay import BLOCK, GetData
+from consensus_parameters import MINING_DIFFICULTY
+import time
+
+# headers-first chain sync: fetch and check the header chain, then pull the block bodies
+# in parallel batches from every peer known to have them, and connect them in order.
+
+MAX_HEADERS = 2000 # headers per Headers message
+
+class GetHeaders:
+    # headers following the first locator hash found on the peer's main chain, up to count
+    def __init__(self, locator, count=MAX_HEADERS):
+        self.locator = locator
+        self.count = count
+
+class Headers:
+    def __init__(self, headers):
+        self.headers = headers # [BlockHeader]
+
+def locator_positions(length):
+    # positions going back from the tip of a chain, 1, 1, 2, 4, 8... apart, always ending at genesis
+    positions = []
+    position = length - 1
+    step = 1
+    while position > 0:
+        positions.append(position)
+        if len(positions) >= 10:
+            step *= 2
+        position -= step
+    if length:
+        positions.append(0)
+    return positions
+
+def block_locator(blockchain):
+    return [blockchain.blocks[position].block_hash for position in locator_positions(len(blockchain.blocks))]
+
+def header_extends(header, block_hash, tail_hash, tail_height, difficulty):
+    # the header builds directly on the tail and its hash meets the difficulty it claims, at least the required one
+    linked = header.prev_block_hash == tail_hash and header.block_height == tail_height + 1
+    valid_pow = difficulty <= header.difficulty <= MAX_DIFFICULTY and block_hash.startswith('0'*header.difficulty)
+    return linked and valid_pow
+
+def headers_after(blockchain, locator, count):
+    # the headers a peer asked for with GetHeaders
+    start = 0
+    for block_hash in locator:
+        if block_hash in blockchain.block_index:
+            start = blockchain.block_index[block_hash] - blockchain.blocks[0].block_height + 1
+            break
+    return [block.header() for block in blockchain.blocks[start:start + min(count, MAX_HEADERS)]]
+
+class ChainSync:
+    '''
+    Tracks the header chain ahead of our tip and the block downloads that fill it in.
+
+    Every block request goes to a peer whose headers reached that height, at most `window`
+    blocks are in flight at once and requests unanswered after `timeout` seconds are sent
+    to another peer, so a sync survives peers disconnecting. Bodies that arrive out of
+    order wait in a buffer until the blocks before them have been connected.
+
+    A block the node rejects is dropped with every header built on it, and the peer that
+    served it isn't asked again. Blocks that failed for a transient reason are fetched again,
+    up to max_retries times.
+    '''
+    def __init__(self, blockchain, send, window=64, batch_size=16, timeout=10, difficulty=MINING_DIFFICULTY, max_retries=3):
+        self.blockchain = blockchain
+        self.send = send # send(message, ports)
+        self.window = window
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.difficulty = difficulty
+        self.max_retries = max_retries
+
+        self.headers = {} # block_hash -> BlockHeader for validated headers beyond our tip
+        self.header_chain = [] # their hashes, in height order
+        self.peer_heights = {} # peer -> highest header height it has sent us
+        self.requested = {} # block_hash -> (peer, time of request)
+        self.received = {} # block_hash -> (block, peer that served it) waiting for its predecessors
+        self.retries = {} # block_hash -> times it was fetched again after a transient failure
+        self.invalid = set() # hashes of rejected blocks and the headers built on them
+        self.rejected_peers = set() # peers that served a rejected block
+
+    def request_headers(self, peers):
+        for peer in peers:
+            self.send(GetHeaders(block_locator(self.blockchain)), [peer])
+
+    def tail(self):
+        # (hash, height) the next header has to build on
+        if self.header_chain:
+            header = self.headers[self.header_chain[-1]]
+            return self.header_chain[-1], header.block_height
+        if len(self.blockchain.blocks):
+            return self.blockchain.blocks[-1].block_hash, self.blockchain.blocks[-1].block_height
+        return EMPTY_HASH, -1
+
+    def on_headers(self, headers, peer):
+        if peer in self.rejected_peers:
+            return
+
+        tail_hash, tail_height = self.tail()
+        for header in headers:
+            block_hash = header.hash()
+            if block_hash in self.invalid or header.prev_block_hash in self.invalid:
+                self.invalid.add(block_hash)
+                print(f'headers from {peer} build on a rejected block. ignoring the rest.')
+                break
+
+            if block_hash in self.headers or block_hash in self.blockchain.block_index:
+                self.peer_heights[peer] = max(self.peer_heights.get(peer, -1), header.block_height)
+                continue
+
+            if not self.header_chain and header.prev_block_hash in self.blockchain.block_index:
+                # a branch off our main chain below its tip. the node's block tree decides whether it wins
+                tail_hash, tail_height = header.prev_block_hash, self.blockchain.block_index[header.prev_block_hash]
+
+            if not header_extends(header, block_hash, tail_hash, tail_height, self.difficulty):
+                print(f'headers from {peer} do not extend our chain. ignoring the rest.')
+                break
+
+            self.headers[block_hash] = header
+            self.header_chain.append(block_hash)
+            self.peer_heights[peer] = header.block_height
+            tail_hash, tail_height = block_hash, header.block_height
+
+        if len(headers) == MAX_HEADERS:
+            self.send(GetHeaders([tail_hash] + block_locator(self.blockchain)), [peer])
+
+        self.schedule()
+
+    def expects(self, block_hash):
+        return block_hash in self.headers
+
+    def schedule(self):
+        # request the lowest missing blocks in batches, spread across the peers that have them
+        wanted = [block_hash for block_hash in self.header_chain
+                  if block_hash not in self.requested and block_hash not in self.received]
+        wanted = wanted[:max(0, self.window - len(self.requested))]
+
+        batches = {}
+        for block_hash in wanted:
+            height = self.headers[block_hash].block_height
+            peers = [peer for peer, peer_height in self.peer_heights.items() if peer_height >= height]
+            if not peers:
+                continue
+            peer = min(peers, key=lambda peer: len(batches.get(peer, [])) + self.in_flight(peer))
+            batches.setdefault(peer, []).append(block_hash)
+
+        now = time.time()
+        for peer, hashes in batches.items():
+            for start in range(0, len(hashes), self.batch_size):
+                batch = hashes[start:start + self.batch_size]
+                for block_hash in batch:
+                    self.requested[block_hash] = (peer, now)
+                self.send(GetData(BLOCK, batch), [peer])
+
+    def in_flight(self, peer):
+        return sum(1 for requested_peer, _ in self.requested.values() if requested_peer == peer)
+
+    def on_block(self, block, peer=None):
+        '''
+        Buffer a requested block and return the (block, peer that served it) pairs that are now
+        ready to connect, in order.
+        '''
+        block_hash = block.block_hash
+        self.requested.pop(block_hash, None)
+        if block.header().hash() != block_hash:
+            return [] # body doesn't match the header we asked for, it will be requested again
+
+        self.received[block_hash] = (block, peer)
+        ready = []
+        while self.header_chain and self.header_chain[0] in self.received:
+            ready_hash = self.header_chain.pop(0)
+            del self.headers[ready_hash]
+            ready.append(self.received.pop(ready_hash))
+
+        self.schedule()
+        return ready
+
+    def retry(self, ready):
+        '''
+        Pairs from on_block that failed to connect for a transient reason go back to the front of
+        the queue to be fetched again. A block that keeps failing is rejected.
+        '''
+        block = ready[0][0]
+        self.retries[block.block_hash] = self.retries.get(block.block_hash, 0) + 1
+        if self.retries[block.block_hash] > self.max_retries:
+            self.reject(ready)
+            return
+
+        for block, _ in reversed(ready):
+            self.headers[block.block_hash] = block.header()
+            self.header_chain.insert(0, block.block_hash)
+        self.schedule()
+
+    def reject(self, ready):
+        '''
+        The first of these pairs from on_block failed validation. Drop it, the rest of ready and
+        every header built on it, and stop asking the peer that served it.
+        '''
+        block, peer = ready[0]
+        self.retries.pop(block.block_hash, None)
+        self.invalid.add(block.block_hash)
+        self.invalid.update(later.block_hash for later, _ in ready[1:])
+
+        # everything left in header_chain extends the rejected block
+        self.invalid.update(self.header_chain)
+        for block_hash in self.header_chain:
+            del self.headers[block_hash]
+            self.requested.pop(block_hash, None)
+            self.received.pop(block_hash, None)
+        self.header_chain = []
+
+        if peer is not None:
+            self.rejected_peers.add(peer)
+            self.peer_heights.pop(peer, None)
+        self.schedule()
+
+    def check_timeouts(self):
+        now = time.time()
+        for block_hash, (peer, requested_at) in list(self.requested.items()):
+            if now - requested_at > self.timeout:
+                del self.requested[block_hash]
+                if len(self.peer_heights) > 1:
+                    self.peer_heights.pop(peer, None) # stop asking a peer that went quiet
+        self.schedule()
@@ -1,18 +1,30 @@
-from elliptic_curve import Point, bitcoin_curve, bitcoin_G
+from elliptic_curve import Point, bitcoin_curve, bitcoin_G, lift_x
 from hash_functions import sha256
 from modular_inverse import inv
+from caches import SignatureCache
 import random
 
+# verified signatures, shared by mempool admission and block validation
+signature_cache = SignatureCache()
+
 class Transaction:
     # class used by the sender to broadcast a transaction to the blockchain
-    def __init__(self, sender_pk, receiver_pk, amount, fee):
+    def __init__(self, sender_pk, receiver_pk, amount, fee, block_height=None):
         self.sender_pk = sender_pk
         self.receiver_pk = receiver_pk
         self.amount = amount # TODO need to incorporate this UTXO style, just doing "amount" and "fee" for now
         self.tx_fee = fee # TODO
         self.signature = None
-
-        self.tx_id = sha256((str(sender_pk.x if sender_pk is not None else None) + str(receiver_pk.x) + str(amount)).encode('utf-8'), return_hex=True)
+        # block rewards commit to the height of their block, otherwise every reward paid to the same key would share a tx_id
+        self.block_height = block_height
+
+        # everything that moves funds is committed to, so the signature covers it: both full keys,
+        # not just x (which -y shares), the amount and the fee
+        sender = f'{sender_pk.x} {sender_pk.y}' if sender_pk is not None else 'None'
+        tx_data = f'{sender} {receiver_pk.x} {receiver_pk.y} {amount} {fee}'
+        if block_height is not None:
+            tx_data += f' {block_height}'
+        self.tx_id = sha256(tx_data.encode('utf-8'), return_hex=True)
         self.message = int(self.tx_id, 16)
 
     def sign(self, sk):
@@ -23,15 +35,24 @@ class Transaction:
 
         nonce = random.randint(1, bitcoin_curve.n - 1)
 
-        r = (bitcoin_G * nonce).x
+        R = bitcoin_G * nonce
+        r = R.x
         s = inv(nonce, bitcoin_curve.n) * (r*sk + message) % bitcoin_curve.n
+        if R.y & 1:
+            # (r, -s) is equally valid. pick the one whose R has even y so batch verification can recover R from r
+            s = bitcoin_curve.n - s
         
-        self.signature = (r, s)
+        self.set_signature((r, s))
+
+    def set_signature(self, signature):
+        self.signature = signature
 
         # include the signature in tx_id - guarentee signed messages are universally unique
-        self.tx_id = sha256((self.tx_id + str(self.signature[0]) + str(self.signature[1])).encode('utf-8'), return_hex=True)
+        unsigned_tx_id = format(self.message, '064x')
+        self.tx_id = sha256((unsigned_tx_id + str(self.signature[0]) + str(self.signature[1])).encode('utf-8'), return_hex=True)
 
-    def verify_signature(self):
+    def verify_signature(self, count_lookup=True):
+        # count_lookup=False when the caller already looked tx up in signature_cache, so the hit rate counts it once
         message = self.message
 
         if self.sender_pk is None:
@@ -41,14 +62,22 @@ class Transaction:
 
         if self.signature is None:
             return False # transaction is not signed
+
+        if signature_cache.check(self) if count_lookup else signature_cache.contains(self):
+            return True
         
         if message.bit_length() > bitcoin_curve.n.bit_length():
             message = message >> (message.bit_length() - bitcoin_curve.n.bit_length())  # ensure message is compatible with group order
         
-        u1 = message * inv(self.signature[1], bitcoin_curve.n)
-        u2 = self.signature[0] * inv(self.signature[1], bitcoin_curve.n)
+        s_inv = inv(self.signature[1], bitcoin_curve.n)
+        u1 = message * s_inv % bitcoin_curve.n
+        u2 = self.signature[0] * s_inv % bitcoin_curve.n
 
-        return (bitcoin_G*u1 + self.sender_pk*u2).x == self.signature[0] % bitcoin_curve.n
+        # u1*G + u2*pk in a single multi-scalar multiplication
+        valid = Point.multi_mul([(bitcoin_G, u1), (self.sender_pk, u2)]).x == self.signature[0] % bitcoin_curve.n
+        if valid:
+            signature_cache.add(self)
+        return valid
 
     def __hash__(self):
         return hash(self.tx_id)
@@ -58,7 +87,62 @@ class Transaction:
         if not isinstance(other, Transaction):
             return False
         return self.tx_id == other.tx_id
-    
+
+def verify_signatures(transactions, count_lookup=True):
+    '''
+    Batch verification: check sum(z_i * (u1_i*G + u2_i*pk_i - R_i)) == 0 for random 128 bit z_i
+    with a single multi-scalar multiplication, where R_i is recovered from r_i with even y.
+    Signatures already in signature_cache are skipped and the rest are added to it if the batch passes.
+    count_lookup=False leaves the cache's hit rate alone, for callers that already counted the lookups.
+    True means every signature is valid. False means at least one may not be (or was signed
+    without the even y convention), so the caller should fall back to tx.verify_signature().
+    '''
+    n = bitcoin_curve.n
+    g_scalar = 0
+    terms = []
+    verified = []
+
+    for tx in transactions:
+        if tx.sender_pk is None:
+            continue # block reward, always valid
+
+        if tx.signature is None:
+            return False
+
+        if signature_cache.check(tx) if count_lookup else signature_cache.contains(tx):
+            continue
+
+        if tx.sender_pk.x is None or not tx.sender_pk.is_on_curve():
+            return False
+
+        r, s = tx.signature
+        if not (0 < r < n and 0 < s < n):
+            return False
+
+        R = lift_x(r, bitcoin_curve)
+        if R is None:
+            return False
+
+        message = tx.message
+        if message.bit_length() > n.bit_length():
+            message = message >> (message.bit_length() - n.bit_length())
+
+        z = random.getrandbits(128) | 1
+        s_inv = inv(s, n)
+        g_scalar += z * message * s_inv
+        terms.append((tx.sender_pk, z * r * s_inv % n))
+        terms.append((R, -z % n))
+        verified.append(tx)
+
+    if not terms:
+        return True
+
+    if Point.multi_mul([(bitcoin_G, g_scalar % n)] + terms).x is not None:
+        return False
+    for tx in verified:
+        signature_cache.add(tx)
+    return True
+
 if __name__ == '__main__':
     from key_relations import valid_key_pair, privateToPublicKey
     import base58
@@ -90,4 +174,41 @@ if __name__ == '__main__':
                      fee=0.00001)
     
     tx.sign(sk=1)
-    print(tx.verify_signature())
\ No newline at end of file
+    print(tx.verify_signature())
+
+    txs = []
+    for sk in range(2, 12):
+        tx = Transaction(sender_pk=bitcoin_G * sk, receiver_pk=bitcoin_G * 987654321, amount=sk, fee=1)
+        tx.sign(sk=sk)
+        txs.append(tx)
+    print(f'batch verification passed with valid signatures: {verify_signatures(txs)}')
+    txs[3].sign(sk=3)
+    print(f'batch verification failed with one bad signature: {not verify_signatures(txs)}')
+
+    # a relayer can't raise the fee or pay the mirror image (x, -y) of the receiver's key
+    tx = Transaction(sender_pk=bitcoin_G * 2, receiver_pk=bitcoin_G * 987654321, amount=1, fee=1)
+    tx.sign(sk=2)
+    higher_fee = Transaction(sender_pk=bitcoin_G * 2, receiver_pk=bitcoin_G * 987654321, amount=1, fee=2)
+    higher_fee.set_signature(tx.signature)
+    receiver = bitcoin_G * 987654321
+    mirrored_receiver = Transaction(sender_pk=bitcoin_G * 2, receiver_pk=Point(receiver.x, bitcoin_curve.p - receiver.y, bitcoin_curve), amount=1, fee=1)
+    mirrored_receiver.set_signature(tx.signature)
+    print(f'fee and receiver signed: {not higher_fee.verify_signature() and not mirrored_receiver.verify_signature()}')
+
+    import time
+    txs = []
+    for sk in range(100, 200):
+        tx = Transaction(sender_pk=bitcoin_G * sk, receiver_pk=bitcoin_G * 987654321, amount=sk, fee=1)
+        tx.sign(sk=sk)
+        txs.append(tx)
+
+    start_time = time.time()
+    all(tx.verify_signature() for tx in txs) # mempool admission
+    admission_time = time.time() - start_time
+
+    hits = signature_cache.hits
+    start_time = time.time()
+    verified = verify_signatures(txs) # the block that includes them
+    block_time = time.time() - start_time
+    print(f'signature cache test passed: {verified and signature_cache.hits == hits + len(txs)}')
+    print(f'{len(txs)} signatures: {round(admission_time*1000, 2)}ms verifying, {round(block_time*1000, 2)}ms from the cache. hit rate {round(100*signature_cache.hit_rate())}%')
\ No newline at end of file
@@ -8,8 +8,9 @@ while True:
     # transaction generator
     sender = random.randint(1, 1000000)
     receiver = random.randint(1, 1000000)
-    tx = Transaction(sender_pk=bitcoin_G * sender,
-                    receiver_pk=bitcoin_G * receiver,
+    sender_pk, receiver_pk = bitcoin_G.mul_many([sender, receiver])
+    tx = Transaction(sender_pk=sender_pk,
+                    receiver_pk=receiver_pk,
                     amount=random.randint(1, 100),
                     fee=random.randint(1, 100))
     
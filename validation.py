@@ -0,0 +1,191 @@
+from transaction import verify_signatures, signature_cache
+from consensus_parameters import MINING_DIFFICULTY, BLOCK_SIZE, BLOCK_REWARD
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# staged block validation. every block goes through the cheapest checks first and is rejected
+# at the first stage it fails, so signatures (by far the most expensive check) are only verified
+# for blocks that are well formed, link up and carry a valid proof of work.
+
+def _invalid_signatures(transactions):
+    # runs in a pool worker. indexes of the transactions in this chunk with a bad signature.
+    # BlockValidator.verify_signatures already counted their cache lookups
+    if verify_signatures(transactions, count_lookup=False):
+        return []
+    return [index for index, tx in enumerate(transactions) if not tx.verify_signature(count_lookup=False)]
+
+class BlockValidator:
+    '''
+    Validates blocks in stages: structure, then height and linkage, then proof of work, then
+    signatures. Signatures of all the blocks still standing are verified together, split across
+    a process pool of `workers` processes once there are at least parallel_threshold of them
+    (workers=1 verifies in the calling process). Results are a failure reason per block, None if
+    the block is valid.
+    '''
+    def __init__(self, difficulty=MINING_DIFFICULTY, block_size=BLOCK_SIZE, block_reward=BLOCK_REWARD,
+                 workers=None, parallel_threshold=64):
+        self.difficulty = difficulty
+        self.block_size = block_size
+        self.block_reward = block_reward
+        self.workers = workers or multiprocessing.cpu_count()
+        self.parallel_threshold = parallel_threshold
+        self.pool = None # started on first use
+
+    def structure(self, block):
+        if block.block_hash is None or block.proof_of_work is None or block.difficulty is None:
+            return 'block is not mined'
+        if not isinstance(block.block_height, int) or block.block_height < 0:
+            return f'invalid block height {block.block_height}'
+        if len(block.transactions) > self.block_size + 1: # + 1 for the block reward
+            return f'{len(block.transactions)} transactions is over the block size'
+
+        rewards = [tx for tx in block.transactions if tx.sender_pk is None]
+        if len(rewards) > 1:
+            return 'more than one block reward'
+        if rewards and rewards[0].amount > self.block_reward:
+            return f'block reward of {rewards[0].amount} is over {self.block_reward}'
+        if rewards and rewards[0].block_height != block.block_height:
+            return 'block reward does not commit to the block height'
+        if len(set(tx.tx_id for tx in block.transactions)) != len(block.transactions):
+            return 'duplicate transactions'
+        return None
+
+    def linkage(self, block, prev_block):
+        # prev_block None means the block must be genesis
+        if prev_block is None:
+            if block.block_height != 0 or block.prev_block_hash:
+                return 'block does not extend the chain'
+        elif block.block_height != prev_block.block_height + 1 or block.prev_block_hash != prev_block.block_hash:
+            return f'block does not extend block {prev_block.block_height}'
+        return None
+
+    def proof_of_work(self, block):
+        if not block.verify_proof_of_work(difficulty=self.difficulty):
+            return 'invalid proof of work'
+        return None
+
+    def validate(self, blocks, prev_block=None, check_linkage=True):
+        '''
+        Validate consecutive blocks, the first building on prev_block (None for genesis).
+        With check_linkage=False blocks are checked on their own, e.g. a new block that may be
+        on a fork. Once a block fails, the blocks after it fail too when linkage is checked.
+        Returns a failure reason per block, None where the block is valid.
+        '''
+        reasons = [None] * len(blocks)
+
+        for position, block in enumerate(blocks):
+            if check_linkage and position and reasons[position - 1] is not None:
+                reasons[position] = 'builds on an invalid block'
+                continue
+
+            reason = self.structure(block)
+            if reason is None and check_linkage:
+                reason = self.linkage(block, blocks[position - 1] if position else prev_block)
+            if reason is None:
+                reason = self.proof_of_work(block)
+            reasons[position] = reason
+
+        self.verify_signatures(blocks, reasons)
+
+        if check_linkage:
+            for position in range(1, len(blocks)):
+                if reasons[position - 1] is not None and reasons[position] is None:
+                    reasons[position] = 'builds on an invalid block'
+        return reasons
+
+    def validate_block(self, block, prev_block=None, check_linkage=False):
+        return self.validate([block], prev_block, check_linkage)[0]
+
+    def verify_signatures(self, blocks, reasons):
+        # fills in reasons for the blocks still valid that contain a bad signature
+        unverified = [] # (block position, transaction)
+        for position, block in enumerate(blocks):
+            if reasons[position] is None:
+                unverified += [(position, tx) for tx in block.transactions
+                               if tx.sender_pk is not None and not signature_cache.check(tx)]
+        if not unverified:
+            return
+
+        transactions = [tx for _, tx in unverified]
+        if self.workers > 1 and len(transactions) >= self.parallel_threshold:
+            if self.pool is None:
+                # fork like mining.MiningEngine, spawn would re-run the node script in every worker
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+            size = -(-len(transactions) // self.workers) # ceiling division
+            starts = range(0, len(transactions), size)
+            chunks = self.pool.map(_invalid_signatures, [transactions[start:start + size] for start in starts])
+            invalid = [start + index for start, chunk_invalid in zip(starts, chunks) for index in chunk_invalid]
+            # workers verify in their own process, record the results in this one
+            invalid_set = set(invalid)
+            for index, tx in enumerate(transactions):
+                if index not in invalid_set:
+                    signature_cache.add(tx)
+        else:
+            invalid = _invalid_signatures(transactions)
+
+        for index in invalid:
+            position, tx = unverified[index]
+            if reasons[position] is None:
+                reasons[position] = f'invalid signature on transaction {tx.tx_id}'
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+if __name__ == '__main__':
+    from blockchain import Block
+    from transaction import Transaction
+    from elliptic_curve import bitcoin_G
+    import time
+
+    def make_chain(length, transactions_per_block):
+        blocks = []
+        prev_block_hash = ''
+        sk = 1
+        for height in range(length):
+            txs = []
+            for _ in range(transactions_per_block):
+                sk += 1
+                tx = Transaction(sender_pk=bitcoin_G * sk, receiver_pk=bitcoin_G * 987654321, amount=sk, fee=0)
+                tx.sign(sk=sk)
+                txs.append(tx)
+            block = Block(block_height=height, prev_block_hash=prev_block_hash, transactions=txs)
+            block.mine(difficulty=1, block_reward=50, block_reward_receiver=bitcoin_G * (height + 42), iterations=int(1e6))
+            blocks.append(block)
+            prev_block_hash = block.block_hash
+        return blocks
+
+    blocks = make_chain(length=20, transactions_per_block=20)
+    signature_cache.entries.clear()
+    signature_cache.hits = signature_cache.misses = 0
+
+    validator = BlockValidator(difficulty=1, block_size=20, workers=1)
+    start_time = time.time()
+    serial = validator.validate(blocks)
+    serial_time = time.time() - start_time
+    print(f'cache lookups counted once: {signature_cache.misses == len(blocks) * 20 and signature_cache.hits == 0}')
+    signature_cache.entries.clear()
+
+    validator = BlockValidator(difficulty=1, block_size=20, workers=max(2, multiprocessing.cpu_count()))
+    start_time = time.time()
+    parallel = validator.validate(blocks)
+    parallel_time = time.time() - start_time
+    print(f'valid chain passed: {serial == parallel == [None] * len(blocks)}')
+    print(f'{len(blocks) * 20} signatures. 1 worker: {round(serial_time, 2)}s, {validator.workers} workers: {round(parallel_time, 2)}s')
+
+    txs = []
+    for sk in range(1000, 1003):
+        tx = Transaction(sender_pk=bitcoin_G * sk, receiver_pk=bitcoin_G * 987654321, amount=sk, fee=0)
+        tx.sign(sk=sk)
+        txs.append(tx)
+    txs[2].sign(sk=5) # wrong key
+    bad_signature = Block(block_height=0, prev_block_hash='', transactions=txs)
+    bad_signature.mine(difficulty=1, block_reward=50, block_reward_receiver=bitcoin_G * 42, iterations=int(1e6))
+    print(f'bad signature found: {validator.validate_block(bad_signature)}')
+
+    bad_pow = list(blocks[:3])
+    bad_pow[1] = Block(block_height=1, prev_block_hash=blocks[0].block_hash, transactions=blocks[1].transactions)
+    bad_pow[1].difficulty, bad_pow[1].proof_of_work, bad_pow[1].block_hash = 1, 0, '1'*64
+    print(f'failure reasons: {validator.validate(bad_pow)}')
+    validator.close()